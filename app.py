@@ -1,31 +1,50 @@
 import os
+import sys
+import time
+import itertools
 from pathlib import Path
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 import logging
 import json
-from shapely.geometry.polygon import Polygon, LineString, Point
+from shapely.geometry import LineString
 
-import ffmpeg
 import cv2
 import numpy as np
 from waggle.plugin import Plugin
 from waggle.data.vision import Camera
 from waggle.data.timestamp import get_timestamp
 
-from record import take_sample
+from record import StreamSession
 from models.yolov7 import YOLOv7_Main
 from models.sort import Sort
+from models.motion import GlobalMotionEstimator
+from models.trajectory import Trajectories
+from tracing import get_tracer, configure as configure_tracing
+from profiling import Profiler
+from detections import DetectionWriter, DetectionReader
+from encoder import open_output
+from coordinates import CoordinateSpace, MODEL_SPACE, load_lanes_config
 
 
-def get_stream_info(stream):
-    try:
-        input_probe = ffmpeg.probe(stream)
-        fps = eval(input_probe['streams'][0]['r_frame_rate'])
-        width = int(input_probe['streams'][0]['width'])
-        height = int(input_probe['streams'][0]['height'])
-        return True, fps, width, height
-    except:
-        return False, 0., 0, 0
+def parse_img_size(value):
+    """ parse_img_size returns (width, height) of WIDTHxHEIGHT, or of a single number for a square
+    """
+    width, _, height = value.partition("x")
+    return int(width), int(height or width)
+
+
+def letterbox_canvas(resized, size, pad):
+    """ letterbox_canvas returns a new frame of size with the frame resized by the detector
+    at pad, as the detector sees it, and a view of the resized frame in it
+    """
+    width, height = size
+    left, top = pad
+    canvas = np.full((height, width, 3), 114, dtype=np.uint8)
+    view = canvas[top:top + resized.shape[0], left:left + resized.shape[1]]
+    view[...] = resized
+    return canvas, view
 
 
 def load_class_names(namesfile):
@@ -37,163 +56,864 @@ def load_class_names(namesfile):
         class_names.append(line)
     return class_names
 
-class Vehicle:
-    def __init__(self, id):
-        self.id = id
-        self.lane_scores = {}
-        self.is_counted = False
-        self.current_position = None
-        self.current_position_poly = None
-        self.reference_point = None
-        self.name = ""
-
-    def update_vehicle(self, classifed_name, position):
-        self.name = classifed_name
-        # left, top, right, bottom
-        self.current_position = position
-        self.current_position_poly = Polygon([(position[0], position[1]), (position[2], position[1]), (position[0], position[3]), (position[2], position[3])])
-        lower_centroid_y_diff = (self.current_position_poly.bounds[3] - self.current_position_poly.centroid.y) / 2
-        lower_centroid = (self.current_position_poly.centroid.x, self.current_position_poly.centroid.y + lower_centroid_y_diff)
-        self.reference_point = lower_centroid
-
-    def is_intersected(self, polyline: LineString):
-        if self.current_position_poly is None:
-            return False
-
-        return polyline.intersects(self.current_position_poly)
-
-    def score_lane(self, lane_name):
-        score = self.lane_scores.get(lane_name, 0)
-        score += 1
-        self.lane_scores[lane_name] = score
-
-    def get_best_lane(self):
-        """ get_best_lane returns the best lane based on the accumulated scores
+def crossing_directions(p0, p1, segments):
+    """ crossing_directions tests the moves from p0 to p1, both arrays of points in shape (N, 2),
+    against an array of segments [[x1, y1, x2, y2], ...] in one pass. It returns an (N, segments)
+    matrix that is 1 where the move crosses the segment from its left to its right,
+    -1 where it crosses from right to left, and 0 where it does not cross.
+    Left and right are as seen on the image when following a line from its first point to its last.
+    A point on the line belongs to its left. A vehicle that stops on the line coming from the
+    right is counted as crossed to the left as it stops, and one coming from the left only once
+    it moves off to the right; either way it is counted once in its direction if it goes on,
+    and not at all if it turns back, as TrafficCounter keeps the net crossing.
+    """
+    ax, ay, bx, by = segments[:, 0], segments[:, 1], segments[:, 2], segments[:, 3]
+    x0, y0 = p0[:, 0:1], p0[:, 1:2]
+    x1, y1 = p1[:, 0:1], p1[:, 1:2]
+    # In image coordinates, y grows downward and a positive cross product is on the right
+    right0 = (bx - ax) * (y0 - ay) - (by - ay) * (x0 - ax) > 0
+    right1 = (bx - ax) * (y1 - ay) - (by - ay) * (x1 - ax) > 0
+    # The endpoints of a crossed segment lie on different sides of the move
+    mx, my = x1 - x0, y1 - y0
+    side_a = mx * (ay - y0) - my * (ax - x0)
+    side_b = mx * (by - y0) - my * (bx - x0)
+    crossed = (right0 != right1) & (side_a * side_b <= 0)
+    return np.where(crossed, np.where(right1, 1, -1), 0)
+
+
+def reference_points(boxes):
+    """ reference_points returns the middle of the lower half of boxes [[left, top, right, bottom], ...]
+    """
+    return np.stack([
+        (boxes[:, 0] + boxes[:, 2]) / 2,
+        (boxes[:, 1] + 3 * boxes[:, 3]) / 4], axis=1)
+
+
+def point_segment_distances(points, segments):
+    """ point_segment_distances returns an (N, segments) matrix of the distances
+    from points in shape (N, 2) to segments [[x1, y1, x2, y2], ...]
+    """
+    a = segments[:, :2]
+    ab = segments[:, 2:] - a
+    length = (ab ** 2).sum(axis=1)
+    # Zero-length segments are their first points
+    length[length == 0] = 1.
+    ap = points[:, None, :] - a[None, :, :]
+    t = np.clip((ap * ab).sum(axis=2) / length, 0., 1.)
+    d = ap - t[..., None] * ab
+    return np.sqrt((d ** 2).sum(axis=2))
+
+
+def compile_segments(lines):
+    """ compile_segments returns the segments of LineStrings as [[x1, y1, x2, y2], ...]
+    and the index of the first segment of each line
+    """
+    segments = []
+    starts = []
+    count = 0
+    for line in lines:
+        points = np.asarray(line.coords, dtype=float)
+        starts.append(count)
+        segments.append(np.concatenate([points[:-1], points[1:]], axis=1))
+        count += len(points) - 1
+    if len(segments) == 0:
+        return np.empty((0, 4)), np.empty(0, dtype=int)
+    return np.concatenate(segments), np.array(starts)
+
+
+class TrafficCounts:
+    """ TrafficCounts accumulates the counts of vehicles
+    """
+    def __init__(self):
+        self.total = 0
+        self.per_lane = {}
+        self.per_class = {}
+        self.per_direction = {}
+        # (lane, direction) -> count
+        self.per_lane_direction = {}
+        # (origin gate, destination gate) -> count
+        self.per_movement = {}
+
+    def add(self, lane, class_name, direction, count=1):
+        self.total += count
+        if lane != "":
+            self.per_lane[lane] = self.per_lane.get(lane, 0) + count
+            key = (lane, direction)
+            self.per_lane_direction[key] = self.per_lane_direction.get(key, 0) + count
+        self.per_class[class_name] = self.per_class.get(class_name, 0) + count
+        self.per_direction[direction] = self.per_direction.get(direction, 0) + count
+
+    def add_movement(self, origin, destination, count=1):
+        key = (origin, destination)
+        self.per_movement[key] = self.per_movement.get(key, 0) + count
+
+    def copy(self):
+        counts = TrafficCounts()
+        counts.total = self.total
+        counts.per_lane = dict(self.per_lane)
+        counts.per_class = dict(self.per_class)
+        counts.per_direction = dict(self.per_direction)
+        counts.per_lane_direction = dict(self.per_lane_direction)
+        counts.per_movement = dict(self.per_movement)
+        return counts
+
+
+class VehicleTable:
+    """ VehicleTable stores the vehicles in parallel arrays, one row per vehicle,
+    and rows maps a track ID to its row. Rows of released vehicles are reused
+    and the arrays double in size when they are full. The recent reference points
+    of each vehicle and their timestamps are kept in the same row of trajectories.
+    """
+    def __init__(self, num_lanes, trajectory_size=32, capacity=64):
+        self.num_lanes = num_lanes
+        self.rows = {}
+        self.free_rows = []
+        self.used = 0
+        self.capacity = 0
+        self.trajectories = Trajectories(0, trajectory_size)
+        self._resize(capacity)
+
+    def _columns(self):
+        # name -> (shape of a row, dtype, initial value)
+        return {
+            "ids": ((), np.float64, 0),
+            # left, top, right, bottom
+            "boxes": ((4,), np.float64, 0),
+            "reference_points": ((2,), np.float64, 0),
+            "previous_points": ((2,), np.float64, 0),
+            "class_nums": ((), np.int16, 0),
+            # Net number of crossings of the count gate; positive for inbound
+            "crossings": ((), np.int8, 0),
+            # Indices of the first gate and the last other gate crossed; -1 if none
+            "origins": ((), np.int16, -1),
+            "destinations": ((), np.int16, -1),
+            "lane_scores": ((self.num_lanes,), np.int32, 0),
+        }
+
+    def _resize(self, capacity):
+        for name, (shape, dtype, fill) in self._columns().items():
+            column = np.full((capacity,) + shape, fill, dtype=dtype)
+            if self.capacity > 0:
+                column[:self.capacity] = getattr(self, name)
+            setattr(self, name, column)
+        self.trajectories.resize(capacity)
+        self.capacity = capacity
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self._columns()) + self.trajectories.nbytes
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get_rows(self, track_ids):
+        """ get_rows returns the rows of the track IDs, adding rows for new IDs
+        """
+        rows = np.empty(len(track_ids), dtype=np.intp)
+        for i, track_id in enumerate(track_ids):
+            row = self.rows.get(track_id)
+            if row is None:
+                if len(self.free_rows) > 0:
+                    row = self.free_rows.pop()
+                else:
+                    if self.used == self.capacity:
+                        self._resize(self.capacity * 2)
+                    row = self.used
+                    self.used += 1
+                self.rows[track_id] = row
+                self.ids[row] = track_id
+            rows[i] = row
+        return rows
+
+    def live_rows(self):
+        return np.fromiter(self.rows.values(), dtype=np.intp, count=len(self.rows))
+
+    def release(self, rows):
+        """ release frees the rows for new vehicles
+        """
+        for row in rows:
+            del self.rows[self.ids[row]]
+            self.free_rows.append(row)
+        for name, (_, _, fill) in self._columns().items():
+            getattr(self, name)[rows] = fill
+        self.trajectories.clear(rows)
+
+    def cross_gate(self, row, gate, direction, count_gate):
+        """ cross_gate records that the vehicle crossed the gate in the direction.
+        The net crossing of the count gate is kept in [-1, 1], so a vehicle
+        crossing the line and turning back is not counted.
+        """
+        if gate == count_gate:
+            self.crossings[row] = max(-1, min(1, self.crossings[row] + direction))
+        if self.origins[row] < 0:
+            self.origins[row] = gate
+        elif gate != self.origins[row]:
+            self.destinations[row] = gate
+
+    def best_lanes(self, rows):
+        """ best_lanes returns the lanes with the highest accumulated scores of the rows
+        and the scores; the lane is -1 for rows without any score
         """
-        best_lane = ""
-        best_score = 0
-        for lane, score in self.lane_scores.items():
-            if score > best_score:
-                best_lane = lane
-                best_score = score
-        return best_lane, best_score
+        if self.num_lanes == 0:
+            return np.full(len(rows), -1), np.zeros(len(rows), dtype=np.int32)
+        scores = self.lane_scores[rows]
+        lanes = scores.argmax(axis=1)
+        best_scores = scores[np.arange(len(rows)), lanes]
+        lanes[best_scores == 0] = -1
+        return lanes, best_scores
 
 
 class TrafficCounter:
-    def __init__(self, lanes, class_names, counter_lane_name="count"):
-        self.lanes = {}
-        self.count_line = None
+    def __init__(self, lanes, class_names, counter_lane_name="count", trajectory_size=32, space=MODEL_SPACE):
+        """ lanes is a list of lines with "name" and "points". The line named after counter_lane_name
+        is the count line. Lines with "type" of "gate" are gates that vehicles cross
+        for origin-destination counts; the count line is also a gate. The others are lanes.
+        space is the CoordinateSpace of the points of lanes, 640x640 by default. The trackers
+        are in the same space until compile maps the lanes into another, e.g. of native frames.
+        """
+        self.lane_points = {}
+        self.gate_points = {}
         for lane in lanes:
             name = lane["name"]
-            points = lane["points"]
+            points = np.asarray(lane["points"], dtype=float)
             poly = LineString(points)
             if poly.is_valid is False:
                 logging.error(f"Lane {name} is invalid")
             if name == counter_lane_name:
-                self.count_line = poly
+                self.gate_points[name] = points
+            elif lane.get("type", "lane") == "gate":
+                self.gate_points[name] = points
             else:
-                self.lanes[name] = poly
+                self.lane_points[name] = points
 
         # This ensures that we have a line for counting vehicles
         # as it is the primary output of the application
-        if self.count_line is None:
+        if counter_lane_name not in self.gate_points:
             raise Exception(f"{counter_lane_name} not found in the config")
-        self.vehicles = {}
+
+        self.lane_names = list(self.lane_points.keys())
+        self.gate_names = list(self.gate_points.keys())
+        self.count_gate = self.gate_names.index(counter_lane_name)
+        self.lanes_space = space
+        # Geometry of the lanes and gates compiled per space of the trackers
+        self.compiled = {}
+        self.space = None
+        self.compile(space)
+
+        self.table = VehicleTable(len(self.lane_names), trajectory_size)
         self.class_names = class_names
+        # Reference points where the tracks not yet confirmed were born, by track ID
+        self.births = {}
+        self.frame_count = 0
+        self.crossed = 0
+        # Counts of the vehicles whose tracks have terminated
+        self.counts = TrafficCounts()
+        self.tracer = get_tracer("counter")
+        # Lanes and gates prerendered for visualize
+        self.overlay = None
+        self.overlay_mask = None
 
-    def get_best_overlap_lane(self, point):
-        best_lane = ""
-        max_distance = 100000
-        for lane_name, lane in self.lanes.items():
-            distance = lane.distance(Point(point))
-            if distance < max_distance:
-                max_distance = distance
-                best_lane = lane_name
-        logging.info(f"{best_lane}: {max_distance} from {point}")
-        return best_lane
-    
-    def update(self, trackers):
+    def compile(self, space):
+        """ compile maps the lanes and gates into the space of the trackers, e.g. the native
+        resolution of the camera, and compiles their segments. The geometry of each space
+        is compiled once and reused.
+        """
+        compiled = self.compiled.get(space)
+        if compiled is None:
+            def map_points(points):
+                if space == self.lanes_space:
+                    return points
+                return self.lanes_space.map_points(points, space)
+            lanes = {name: LineString(map_points(points)) for name, points in self.lane_points.items()}
+            gates = {name: LineString(map_points(points)) for name, points in self.gate_points.items()}
+            # Segments of all lanes and gates as [[x1, y1, x2, y2], ...]
+            # and the index of the first segment of each lane or gate
+            lane_segments, lane_starts = compile_segments(lanes.values())
+            gate_segments, gate_starts = compile_segments(gates.values())
+            compiled = (lanes, gates, lane_segments, lane_starts, gate_segments, gate_starts)
+            self.compiled[space] = compiled
+        (self.lanes, self.gates, self.lane_segments, self.lane_starts,
+            self.gate_segments, self.gate_starts) = compiled
+        self.count_line = self.gates[self.gate_names[self.count_gate]]
+        self.space = space
+        self.overlay = None
+
+    def get_best_overlap_lanes(self, points):
+        """ get_best_overlap_lanes returns the index of the closest lane to each point
+        """
+        distances = point_segment_distances(points, self.lane_segments)
+        return np.minimum.reduceat(distances, self.lane_starts, axis=1).argmin(axis=1)
+
+    def gate_crossings(self, p0, p1):
+        """ gate_crossings returns an (N, gates) matrix of the directions in which
+        the moves from p0 to p1 cross the gates, 0 where they do not cross
+        """
+        directions = crossing_directions(p0, p1, self.gate_segments)
+        # A move through a vertex of a gate may cross its two adjacent segments
+        return np.sign(np.add.reduceat(directions, self.gate_starts, axis=1))
+
+    def update(self, trackers, timestamp=None):
         """ Update finds the best matching lane number of each tracker.
         The points representing a lane and trackers should share the same coordination space
         because they are directly compared.
+        The timestamp of the frame is recorded in the trajectories of vehicles;
+        the frame number is used if not given.
         """
-        for tracker in trackers:
-            # Step: Get vehicle of the tracker
-            track_id = tracker[4]
-            vehicle = self.vehicles.get(track_id, Vehicle(track_id))
-
-            # Step: Update the vehicle class name and position
-            track_name = self.class_names[int(tracker[-1])]
-            track_pos = tracker[:4]
-            vehicle.update_vehicle(track_name, track_pos)
-            logging.info(f"{track_id}-{track_name}: {track_pos}")
-
-            # Step: Find the best lane matched to the current vehicle position
-            best_matched_lane = self.get_best_overlap_lane(vehicle.reference_point)
-            if best_matched_lane != "":
-                vehicle.score_lane(best_matched_lane)
-
-            # Step: Mark the vehicle if it steps on the line to be counted
-            if vehicle.is_counted is False and vehicle.is_intersected(self.count_line):
-                vehicle.is_counted = True
-
-            # Step: Store the updated vehicle
-            self.vehicles[track_id] = vehicle
-
-    def visualize(self, frame, trackers):
-        for _, points in self.lanes.items():
-            points = np.array(points, np.int32)
+        self.frame_count += 1
+        # Number of vehicles crossing the count line in this frame
+        self.crossed = 0
+        if timestamp is None:
+            timestamp = self.frame_count
+        if len(trackers) == 0:
+            return
+
+        # Step: Get vehicles of the trackers
+        table = self.table
+        rows = table.get_rows(trackers[:, 4])
+
+        # Step: Update the vehicle class and position
+        # The class is the majority vote of the tracker, so it may change over frames
+        table.class_nums[rows] = trackers[:, -1]
+        boxes = trackers[:, :4]
+        table.boxes[rows] = boxes
+        points = reference_points(boxes)
+        table.previous_points[rows] = table.reference_points[rows]
+        # A new vehicle moves from where its track was born, so that a crossing while the
+        # tracker confirmed the track is counted too
+        for i in np.flatnonzero(table.trajectories.sizes[rows] == 0):
+            table.previous_points[rows[i]] = self.births.pop(trackers[i, 4], points[i])
+        table.reference_points[rows] = points
+        table.trajectories.append(rows, points, timestamp)
+
+        # Step: Find the best lane matched to the current vehicle positions
+        best_lanes = None
+        if len(self.lane_names) > 0:
+            best_lanes = self.get_best_overlap_lanes(points)
+            table.lane_scores[rows, best_lanes] += 1
+
+        # Step: Count the vehicles whose reference points cross the gates,
+        # testing all vehicles against all gates at once
+        directions = self.gate_crossings(table.previous_points[rows], points)
+        self.crossed = int(np.count_nonzero(directions[:, self.count_gate]))
+        for v, gate in zip(*np.nonzero(directions)):
+            table.cross_gate(rows[v], gate, directions[v, gate], self.count_gate)
+
+        if self.tracer.active(self.frame_count):
+            self.tracer.emit(
+                frame=self.frame_count,
+                ids=trackers[:, 4],
+                classes=table.class_nums[rows],
+                points=points.round(1),
+                lanes=best_lanes,
+                crossings=table.crossings[rows])
+
+    def render_overlay(self, shape):
+        """ render_overlay draws the lanes and gates, which do not change over frames, once
+        into an overlay and a mask of the pixels drawn
+        """
+        overlay = np.zeros(shape, dtype=np.uint8)
+        mask = np.zeros(shape[:2], dtype=np.uint8)
+        scale = self.frame_scale(shape)
+        for _, lane in self.lanes.items():
+            points = np.array(np.array(lane.coords) * scale, np.int32)
+            points = points.reshape((-1, 1, 2))
+            cv2.polylines(overlay, [points], isClosed=False, color=(0, 255, 255), thickness=4)
+            cv2.polylines(mask, [points], isClosed=False, color=255, thickness=4)
+
+        for name, gate in self.gates.items():
+            points = np.array(np.array(gate.coords) * scale, np.int32)
             points = points.reshape((-1, 1, 2))
-            frame = cv2.polylines(frame, [points], isClosed=False, color=(0, 255, 255), thickness=4)
-        
-        points = np.array(self.count_line, np.int32)
-        points = points.reshape((-1, 1, 2))
-        frame = cv2.polylines(frame, [points], isClosed=False, color=(0, 0, 255), thickness=4)
+            color = (0, 0, 255) if gate is self.count_line else (255, 0, 255)
+            cv2.polylines(overlay, [points], isClosed=False, color=color, thickness=4)
+            cv2.polylines(mask, [points], isClosed=False, color=255, thickness=4)
+        self.overlay = overlay
+        self.overlay_mask = mask
 
+    def frame_scale(self, shape):
+        """ frame_scale returns the scale of x and y from the space of the trackers to a frame
+        """
+        return self.space.scale_to(CoordinateSpace(shape[1], shape[0]))
+
+    def snapshot(self, trackers):
+        """ snapshot returns the vehicles of the trackers as visualize draws them, so that a frame
+        can be drawn after the vehicles have moved on: their IDs, class names, boxes, whether they
+        have crossed the count line, reference points, and best lanes with their scores
+        """
         # We visualize only the vehicles being tracked currently
-        # If we want to visualize all tracked vehicles use the for loop below
-        # for vehicle_id, vehicle in self.vehicles.items():
-        for tracker in trackers:
-            track_id = tracker[4]
-            vehicle = self.vehicles.get(track_id, None)
-            if vehicle is None:
-                continue
-        
-            vehicle_id = track_id
-            name = vehicle.name
-            l = vehicle.current_position[0]
-            t = vehicle.current_position[1]
-            r = vehicle.current_position[2]
-            b = vehicle.current_position[3]
-            best_lane, best_score = vehicle.get_best_lane()
-            if vehicle.is_counted:
+        table = self.table
+        track_ids = [track_id for track_id in trackers[:, 4] if track_id in table.rows]
+        rows = np.array([table.rows[track_id] for track_id in track_ids], dtype=np.intp)
+        best_lanes, best_scores = table.best_lanes(rows)
+        names = [self.class_names[class_num] for class_num in table.class_nums[rows]]
+        lanes = [self.lane_names[lane] if lane >= 0 else "" for lane in best_lanes]
+        return list(zip(track_ids, names, table.boxes[rows], table.crossings[rows] != 0,
+            table.reference_points[rows], lanes, best_scores))
+
+    def visualize(self, frame, vehicles):
+        """ visualize draws the lanes and the vehicles of a snapshot on the frame, which may be
+        a resize of the frames in the space of the trackers
+        """
+        if self.overlay is None or self.overlay.shape != frame.shape:
+            self.render_overlay(frame.shape)
+        # One masked copy in place, regardless of the number of lanes and their points
+        frame = cv2.copyTo(self.overlay, self.overlay_mask, frame)
+
+        scale = self.frame_scale(frame.shape)
+        for vehicle_id, name, box, crossed, reference_point, best_lane, best_score in vehicles:
+            l, t, r, b = box * np.tile(scale, 2)
+            if crossed:
                 frame = cv2.rectangle(frame, (int(l), int(t)), (int(r), int(b)), (255, 0, 0), 2)
             else:
                 frame = cv2.rectangle(frame, (int(l), int(t)), (int(r), int(b)), (255, 255, 0), 2)
-            ref_point = vehicle.reference_point
+            ref_point = reference_point * scale
             frame = cv2.circle(frame, (int(ref_point[0]), int(ref_point[1])), 5, (255, 0, 0), -1)
             # frame = cv2.putText(frame, f'{int(vehicle_id)}', (int(ref_point[1]), int(ref_point[0])), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255,0,0), 2)
             frame = cv2.putText(frame, f'{int(vehicle_id)}:{name}', (int(l), int(t)-20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,255,0), 2)
             frame = cv2.putText(frame, f'{best_lane}:{best_score}', (int(l), int(t)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,255,0), 2)
         return frame
 
+    def finalize(self, events):
+        """ finalize takes the lifecycle events of the tracker and moves the vehicles
+        whose tracks have terminated into the counts. This keeps the memory bounded
+        by the number of vehicles being tracked, not the number of vehicles seen.
+        It also keeps where the tracks not yet confirmed were born for update.
+        """
+        table = self.table
+        events = list(events)
+        for event in events:
+            if event.kind == "born" and event.track_id not in table.rows:
+                self.births[event.track_id] = reference_points(event.bbox[None, :4])[0]
+            elif event.kind == "terminated":
+                self.births.pop(event.track_id, None)
+        rows = [table.rows[event.track_id] for event in events
+            if event.kind == "terminated" and event.track_id in table.rows]
+        if len(rows) == 0:
+            return
+        rows = np.array(rows, dtype=np.intp)
+        self.tally(rows, self.counts)
+        if self.tracer.active(self.frame_count):
+            self.tracer.emit(
+                frame=self.frame_count,
+                released=table.ids[rows],
+                crossings=table.crossings[rows])
+        table.release(rows)
+
+    def tally(self, rows, counts):
+        """ tally adds the counted vehicles of the rows to the counts
+        """
+        table = self.table
+        moving = rows[table.destinations[rows] >= 0]
+        if len(moving) > 0:
+            movements = np.stack([table.origins[moving], table.destinations[moving]], axis=1)
+            movements, n = np.unique(movements, axis=0, return_counts=True)
+            for (origin, destination), count in zip(movements, n):
+                counts.add_movement(self.gate_names[origin], self.gate_names[destination], int(count))
+
+        counted = rows[table.crossings[rows] != 0]
+        if len(counted) == 0:
+            return
+        lanes, _ = table.best_lanes(counted)
+        # The class is the majority voted by the tracker over its detections
+        keys = np.stack([lanes, table.class_nums[counted], table.crossings[counted]], axis=1)
+        keys, n = np.unique(keys, axis=0, return_counts=True)
+        for (lane, class_num, crossing), count in zip(keys, n):
+            lane_name = self.lane_names[lane] if lane >= 0 else ""
+            direction = "inbound" if crossing > 0 else "outbound"
+            counts.add(lane_name, self.class_names[class_num], direction, int(count))
+
     def report_results(self):
-        total_count = 0
-        count_per_lane = {}
-        for vehicle_id, vehicle in self.vehicles.items():
-            if not vehicle.is_counted:
-                continue
-
-            total_count += 1
-            best_lane, _ = vehicle.get_best_lane()
-            logging.info(f"{vehicle.name} ({vehicle_id}) is counted and stayed in lane {best_lane}")
-            if best_lane != "":
-                lane_count = count_per_lane.get(best_lane, 0)
-                lane_count += 1
-                count_per_lane[best_lane] = lane_count
-        return total_count, count_per_lane
+        """ report_results returns TrafficCounts of the terminated and the currently tracked vehicles
+        """
+        counts = self.counts.copy()
+        self.tally(self.table.live_rows(), counts)
+        return counts
+
+
+def track_and_count(results, frame_index, timestamp, mot_tracker, traffic_counter, profiler, warp=None):
+    """ track_and_count updates the trackers with the detections of a frame and counts the vehicles.
+    It returns the confirmed trackers.
+    """
+    sort_tracer = get_tracer("sort")
+    # Step: Update the trackers
+    with profiler.stage("track"):
+        if len(results) == 0:
+            # SORT recommends updating it even with no detections
+            trackers = mot_tracker.update(warp=warp)
+        else:
+            # for result in results:
+            #     result[0] = result[0] * width/640  ## x1
+            #     result[1] = result[1] * height/640  ## y1
+            #     result[2] = result[2] * width/640  ## x2
+            #     result[3] = result[3] * height/640  ## y2
+            # results[:, 2:4] += results[:, 0:2] #convert to [x1,y1,w,h] to [x1,y1,x2,y2]
+            det = results
+            trackers = mot_tracker.update(det, warp=warp)
+    if sort_tracer.active(frame_index):
+        sort_tracer.emit(
+            frame=frame_index,
+            detections=len(results),
+            trackers=len(mot_tracker.trackers),
+            confirmed=len(trackers),
+            events=[(event.kind, event.track_id) for event in mot_tracker.events()])
+
+    # Step: Update the traffic counter for recognized tracks
+    with profiler.stage("count"):
+        traffic_counter.update(trackers, timestamp)
+        # Step: Release the vehicles whose tracks have terminated
+        traffic_counter.finalize(mot_tracker.events())
+    return trackers
+
+
+class OutputFrame:
+    """ OutputFrame is a frame of the validation video, rendered only if an output policy writes it:
+    the frame as resized by the detector on the letterbox canvas of size at pad, with the lanes
+    and the vehicles of the snapshot. borrowed tells that resized is a view of a frame that the
+    reader reuses, e.g. a slot of shared memory, which is copied if the frame is kept for later.
+    """
+    def __init__(self, traffic_counter, resized, size, pad, vehicles, borrowed=False):
+        self.traffic_counter = traffic_counter
+        self.resized = resized
+        self.size = size
+        self.pad = pad
+        self.vehicles = vehicles
+        self.borrowed = borrowed
+
+    def keep(self):
+        if self.borrowed:
+            self.resized = self.resized.copy()
+            self.borrowed = False
+        return self
+
+    def render(self):
+        out_frame, view = letterbox_canvas(self.resized, self.size, self.pad)
+        self.traffic_counter.visualize(view, self.vehicles)
+        return out_frame
+
+
+class CameraPipeline:
+    """ CameraPipeline holds the tracking and counting state of a camera, and steps it through
+    the frames of the camera as they are detected, by process_video for one camera or
+    by process_cameras for many. If detection_writer is given, the detections of each frame
+    are saved for replay_detections.
+    """
+    def __init__(self, name, input_video_path, timestamp, mot_tracker, traffic_counter,
+            motion_estimator=None, out_stream=None, output_file="", detection_writer=None):
+        self.name = name
+        self.input_video_path = input_video_path
+        self.timestamp = timestamp
+        self.mot_tracker = mot_tracker
+        self.traffic_counter = traffic_counter
+        self.motion_estimator = motion_estimator
+        self.out_stream = out_stream
+        self.output_file = output_file
+        self.detection_writer = detection_writer
+        self.detector_tracer = get_tracer("detector")
+
+    def step(self, frame_index, sample, results, resized, size, pad, profiler):
+        """ step tracks and counts the detections of a frame, in the coordinates of the frame,
+        and writes the visualized frame to the output. Motion estimation and visualization
+        reuse resized, the frame as resized by the detector into its input of size at pad,
+        so that a frame is resized once.
+        """
+        frame = sample.data
+        frame_space = CoordinateSpace(frame.shape[1], frame.shape[0])
+        if self.traffic_counter.space != frame_space:
+            # Tracking and counting run in the native resolution of the frames
+            self.traffic_counter.compile(frame_space)
+        if self.detection_writer is not None and "space" not in self.detection_writer.meta:
+            self.detection_writer.meta["space"] = [frame_space.width, frame_space.height]
+        resized_space = CoordinateSpace(resized.shape[1], resized.shape[0])
+
+        # Step (optional): Estimate the camera motion to compensate the track predictions
+        warp = None
+        if self.motion_estimator is not None:
+            with profiler.stage("motion"):
+                warp = self.motion_estimator.estimate(resized, frame_space.map_boxes(results[:, :4], resized_space))
+                warp = resized_space.map_warp(warp, frame_space)
+
+        if self.detector_tracer.active(frame_index):
+            camera = {"camera": self.name} if self.name != "" else {}
+            self.detector_tracer.emit(frame=frame_index, detections=results.round(2), **camera)
+        if self.detection_writer is not None:
+            self.detection_writer.write(results, sample.timestamp)
+
+        trackers = track_and_count(results, frame_index, sample.timestamp,
+            self.mot_tracker, self.traffic_counter, profiler, warp=warp)
+
+        # Step (optional): Visualize the result for validation
+        # Passing the trackers allows visualization of vehicles currently being tracked.
+        # The policy renders the frame only if it writes it, now or around a later event
+        if self.out_stream is not None and self.out_stream.wants(frame_index):
+            with profiler.stage("encode"):
+                out_frame = OutputFrame(self.traffic_counter, resized, size, pad,
+                    self.traffic_counter.snapshot(trackers), borrowed=np.shares_memory(resized, frame))
+                self.out_stream.write(out_frame, event=self.traffic_counter.crossed > 0)
+
+
+def process_video(input_video_path, yolov7_main, mot_tracker, traffic_counter, profiler,
+        motion_estimator=None, out_stream=None, detection_writer=None, frame_offset=0, reader=None):
+    """ process_video runs detection, tracking and counting over the frames of the video.
+    The result is accumulated in traffic_counter and the time of each stage in profiler.
+    Videos that continue one another, e.g. segments of a capture, are processed by calls with
+    the same trackers and counter; frame_offset is the number of frames before the video.
+    It returns the number of frames of the video. reader reads the frames of the video like
+    Camera, which reads them by default, e.g. a ParallelReader or a RingReader.
+    If out_stream is given, the visualized frames are written to it by its policy, see encoder.open_output.
+    If detection_writer is given, the detections of each frame are saved for replay_detections.
+    """
+    pipeline = CameraPipeline("", input_video_path, None, mot_tracker, traffic_counter,
+        motion_estimator=motion_estimator, out_stream=out_stream, detection_writer=detection_writer)
+    frame_index = frame_offset - 1
+    if reader is None:
+        reader = Camera(Path(input_video_path))
+    with reader as camera:
+        for frame_index, sample in enumerate(profiler.iterate("decode", camera.stream()), frame_offset):
+            frame_start = time.monotonic()
+
+            # Step: Detection of vehicles in the coordinates of the frame
+            with profiler.stage("detect"):
+                pred = yolov7_main.infer(sample.data)
+            with profiler.stage("nms"):
+                detections = yolov7_main.suppress(pred)
+                results = np.asarray(detections[0].cpu().detach())
+
+            pipeline.step(frame_index, sample, results, yolov7_main.resized[0],
+                yolov7_main.size, yolov7_main.ratio_pads[0][1], profiler)
+            profiler.stage("frame").record(time.monotonic() - frame_start)
+            # break
+    return frame_index + 1 - frame_offset
+
+
+def process_cameras(pipelines, yolov7_main, profiler):
+    """ process_cameras runs the videos of multiple cameras together. The frames of all cameras
+    at a time are detected in one batch by the shared detector, and each camera is tracked
+    and counted by its own pipeline. A camera whose video ends drops out of the batch.
+    """
+    with ExitStack() as stack:
+        streams = [stack.enter_context(Camera(Path(p.input_video_path))).stream() for p in pipelines]
+        active = list(range(len(pipelines)))
+        frame_index = 0
+        while True:
+            samples = []
+            with profiler.stage("decode"):
+                for i in list(active):
+                    sample = next(streams[i], None)
+                    if sample is None:
+                        active.remove(i)
+                    else:
+                        samples.append((pipelines[i], sample))
+            if len(samples) == 0:
+                return
+            frame_start = time.monotonic()
+
+            # Step: Detection of vehicles in all cameras at once
+            with profiler.stage("detect"):
+                pred = yolov7_main.infer_batch([sample.data for _, sample in samples])
+            with profiler.stage("nms"):
+                detections = yolov7_main.suppress(pred)
+
+            for i, ((pipeline, sample), detection) in enumerate(zip(samples, detections)):
+                results = np.asarray(detection.cpu().detach())
+                pipeline.step(frame_index, sample, results, yolov7_main.resized[i],
+                    yolov7_main.size, yolov7_main.ratio_pads[i][1], profiler)
+            profiler.stage("frame").record(time.monotonic() - frame_start)
+            frame_index += 1
+
+
+def replay_detections(detection_reader, mot_tracker, traffic_counter, profiler):
+    """ replay_detections runs tracking and counting over detections saved by process_video,
+    so that the tracker and counter can be tuned without decoding and detecting again.
+    """
+    if "space" in detection_reader.meta:
+        traffic_counter.compile(CoordinateSpace(*detection_reader.meta["space"]))
+    for frame_index, (timestamp, results) in enumerate(profiler.iterate("replay", detection_reader)):
+        frame_start = time.monotonic()
+        track_and_count(results, frame_index, timestamp, mot_tracker, traffic_counter, profiler)
+        profiler.stage("frame").record(time.monotonic() - frame_start)
+
+
+def log_profile(profiler):
+    for name, summary in profiler.summary().items():
+        logging.info(f"Stage {name}: p50 {summary['p50'] * 1e3:.1f} ms, p95 {summary['p95'] * 1e3:.1f} ms, max {summary['max'] * 1e3:.1f} ms, {summary['fps']:.1f} FPS")
+
+
+def publish_counts(plugin, counts, timestamp, meta=None):
+    # A dict of our own, as the caller's meta may be reused
+    meta = dict(meta) if meta is not None else {}
+    logging.info(f"Publishing total count: {counts.total}")
+    plugin.publish("env.traffic.count.total", counts.total, meta=meta, timestamp=timestamp)
+
+    for lane, count in counts.per_lane.items():
+        logging.info(f"Publishing count for {lane}: {count}")
+        plugin.publish(f"env.traffic.count.{lane}", count, meta=meta, timestamp=timestamp)
+
+    for direction, count in counts.per_direction.items():
+        logging.info(f"Publishing {direction} count: {count}")
+        plugin.publish(f"env.traffic.count.{direction}", count, meta=meta, timestamp=timestamp)
+
+    for (lane, direction), count in counts.per_lane_direction.items():
+        logging.info(f"Publishing {direction} count for {lane}: {count}")
+        plugin.publish(f"env.traffic.count.{lane}.{direction}", count, meta=meta, timestamp=timestamp)
+
+    for (origin, destination), count in counts.per_movement.items():
+        logging.info(f"Publishing count from {origin} to {destination}: {count}")
+        plugin.publish(f"env.traffic.count.od.{origin}.{destination}", count, meta=meta, timestamp=timestamp)
+
+    for class_name, count in counts.per_class.items():
+        logging.info(f"Publishing count for {class_name}: {count}")
+        plugin.publish(f"env.traffic.count.class.{class_name}", count, meta=meta, timestamp=timestamp)
+
+
+def publish_results(traffic_counter, profiler, timestamp, output_file=""):
+    log_profile(profiler)
+    with Plugin() as plugin:
+        profiler.publish(plugin, timestamp=timestamp)
+        publish_counts(plugin, traffic_counter.report_results(), timestamp)
+
+        if output_file != "":
+            logging.info(f"Uploading output video")
+            plugin.upload_file(output_file, timestamp=timestamp)
+
+
+def replay(args, lanes, lanes_space):
+    """ replay runs tracking and counting over the detections saved with --save-detections
+    """
+    logging.info(f"Replaying detections from {args.replay_detections}")
+    detection_reader = DetectionReader(args.replay_detections)
+    timestamp = detection_reader.meta.get("timestamp", get_timestamp())
+    if args.output_file != "":
+        logging.warning("Output video is not available when replaying detections; ignoring --output-file")
+    if args.motion_compensation:
+        logging.warning("Camera motion compensation needs frames; ignoring --motion-compensation")
+
+    trace_sink = None
+    if args.trace != "":
+        trace_sink = configure_tracing(args.trace.split(","), args.trace_file, args.trace_sample)
+
+    class_names = load_class_names(args.labels)
+    mot_tracker = Sort(max_age=args.max_age,
+        min_hits=args.min_hits,
+        iou_threshold=args.iou_threshold)
+    traffic_counter = TrafficCounter(lanes, class_names, space=lanes_space)
+    profiler = Profiler()
+    replay_detections(detection_reader, mot_tracker, traffic_counter, profiler)
+    if trace_sink is not None:
+        trace_sink.close()
+
+    publish_results(traffic_counter, profiler, timestamp)
+    return 0
+
+
+def load_lanes(config):
+    """ load_lanes returns the lanes of a camera config given by "lanes-file" or "lanes"
+    """
+    if "lanes-file" in config:
+        return json.loads(Path(config["lanes-file"]).read_text())
+    return config["lanes"]
+
+
+def main_cameras(args, cameras):
+    """ main_cameras processes multiple cameras with one shared detector.
+    Each camera config has a name, a stream or input-file, lanes-file or lanes,
+    and optionally an output-file,
+        [{"name": "left", "stream": "left", "lanes-file": "/root/LEFTLANE"},
+         {"name": "right", "stream": "right", "lanes-file": "/root/RIGHTLANE"}]
+    """
+    names = [camera["name"] for camera in cameras]
+    if len(set(names)) != len(names):
+        logging.error("Camera names must be unique")
+        return -1
+    if args.capture_dir != "":
+        logging.warning("Capturing into segments is not available with multiple cameras; ignoring --capture-dir")
+    if args.decode_process:
+        logging.warning("Decoding in another process is not available with multiple cameras; ignoring --decode-process")
+    if args.save_detections != "":
+        logging.warning("Saving detections is not available with multiple cameras; ignoring --save-detections")
+
+    # Record all cameras at the same time so that the counts cover the same period
+    def record(camera):
+        session = StreamSession(camera.get("stream", camera.get("input-file")), args.stream_cache, args.stream_cache_ttl)
+        if "stream" in camera:
+            logging.info(f"Recording {camera['name']} from {camera['stream']} for {args.duration} seconds")
+            result, input_video_path, timestamp = session.take_sample(args.duration, filename=f"sample_{camera['name']}.mp4")
+        else:
+            result, input_video_path, timestamp = True, camera["input-file"], get_timestamp()
+        if result is False:
+            return False, "", 0, None
+        # Known from the recording of the stream, or else read only for the output video
+        info = None
+        if camera.get("output-file", "") != "":
+            info = session.info(input_video_path)
+            if info is None:
+                logging.warning(f"Counting {camera['name']} without the video info; no output video is written")
+        return result, input_video_path, timestamp, info
+    with ThreadPoolExecutor(max_workers=len(cameras)) as executor:
+        samples = list(executor.map(record, cameras))
+    for camera, (result, _, _, _) in zip(cameras, samples):
+        if result is False:
+            logging.error(f"Failed to take a sample from {camera['name']}")
+            return -1
+
+    trace_sink = None
+    if args.trace != "":
+        trace_sink = configure_tracing(args.trace.split(","), args.trace_file, args.trace_sample)
+
+    logging.info("Loading models")
+    class_names = load_class_names(args.labels)
+    yolov7_main = YOLOv7_Main(args.model, args.det_thr, args.iou_thres, img_size=parse_img_size(args.img_size))
+    logging.info(f"Detector input is {yolov7_main.size[0]}x{yolov7_main.size[1]}")
+    pipelines = []
+    for camera, (_, input_video_path, timestamp, info) in zip(cameras, samples):
+        mot_tracker = Sort(max_age=args.max_age,
+            min_hits=args.min_hits,
+            iou_threshold=args.iou_threshold)
+        lanes, lanes_space = load_lanes_config(load_lanes(camera))
+        traffic_counter = TrafficCounter(lanes, class_names, space=lanes_space)
+        motion_estimator = None
+        if args.motion_compensation:
+            motion_estimator = GlobalMotionEstimator(scale=args.motion_scale)
+        output_file = camera.get("output-file", "")
+        out_stream = None
+        if output_file != "" and info is None:
+            output_file = ""
+        if output_file != "":
+            # The validation video is of the letterboxed input of the detector
+            out_stream = open_output(output_file, info.fps, yolov7_main.size, args.encoder, args.crf, args.preset,
+                args.output_policy, args.output_every, args.pre_roll, args.post_roll, args.highlight_frames)
+        pipelines.append(CameraPipeline(camera["name"], input_video_path, timestamp, mot_tracker, traffic_counter,
+            motion_estimator=motion_estimator, out_stream=out_stream, output_file=output_file))
+
+    profiler = Profiler()
+    process_cameras(pipelines, yolov7_main, profiler)
+    for pipeline in pipelines:
+        if pipeline.out_stream is not None:
+            pipeline.out_stream.release()
+            if pipeline.out_stream.written == 0:
+                logging.info(f"No frames of {pipeline.name} were written by the output policy")
+                pipeline.output_file = ""
+    if trace_sink is not None:
+        trace_sink.close()
+
+    log_profile(profiler)
+    with Plugin() as plugin:
+        profiler.publish(plugin, timestamp=pipelines[0].timestamp)
+        for pipeline in pipelines:
+            meta = {"camera": pipeline.name}
+            publish_counts(plugin, pipeline.traffic_counter.report_results(), pipeline.timestamp, meta=meta)
+            if pipeline.output_file != "":
+                logging.info(f"Uploading output video of {pipeline.name}")
+                plugin.upload_file(pipeline.output_file, meta=meta, timestamp=pipeline.timestamp)
+    return 0
+
 
 def main(args):
+    if args.cameras_file:
+        logging.info(f"Loading camera configurations from {args.cameras_file}")
+        return main_cameras(args, json.loads(args.cameras_file.read_text()))
+    elif args.cameras != "":
+        logging.info("Loading camera configurations from cameras argument")
+        return main_cameras(args, json.loads(args.cameras.strip()))
+
     if args.lanes_file:
         logging.info(f"Loading Lane configurations from {args.lanes_file}")
         lanes = json.loads(args.lanes_file.read_text())
@@ -203,85 +923,120 @@ def main(args):
     else:
         logging.error("No lane configurations provided")
         return -1
+    lanes, lanes_space = load_lanes_config(lanes)
+
+    if args.replay_detections != "":
+        return replay(args, lanes, lanes_space)
 
-    if args.stream != "":
+    if args.stream == "" and args.input_file == "":
+        print("Error: Please provide a stream or input file")
+        return -1
+    session = StreamSession(args.stream if args.stream != "" else args.input_file, args.stream_cache, args.stream_cache_ttl)
+    recorder = None
+    if args.stream != "" and args.capture_dir != "":
+        logging.info(f"Capturing {args.stream} for {args.duration} seconds in segments of {args.segment_duration} seconds in {args.capture_dir}")
+        recorder = session.segment_recorder(args.capture_dir, args.segment_duration, args.segment_wrap)
+        recorder.start(args.duration)
+        segments = recorder.segments()
+        first = next(segments, None)
+        if first is None:
+            print("Error: Failed to capture a segment")
+            return -1
+        input_video_path, _ = first
+        timestamp = recorder.timestamp
+        segments = itertools.chain([first], segments)
+    elif args.stream != "":
         logging.info(f"Recording from {args.stream} for {args.duration} seconds")
-        result, input_video_path, timestamp = take_sample(args.stream, args.duration)
+        result, input_video_path, timestamp = session.take_sample(args.duration)
         if result is False:
             print("Error: Failed to take a sample")
             return -1
     else:
-        if args.input_file == "":
-            print("Error: Please provide a stream or input file")
-            return -1
         logging.info(f"Taking input from {args.input_file}")
         # TODO: Need to provide a timestamp
         input_video_path = args.input_file
         timestamp = get_timestamp()
+    # Known from the recording of the stream, or else read only if needed, from the cache
+    # or by probing the recording rather than the live stream
+    info = None
+    if args.output_file != "" or args.save_detections != "" or args.decode_process:
+        info = session.info(input_video_path)
+        if info is None:
+            logging.warning("Counting without the video info; no output video is written")
+
+    trace_sink = None
+    if args.trace != "":
+        trace_sink = configure_tracing(args.trace.split(","), args.trace_file, args.trace_sample)
 
     logging.info("Loading models")
     class_names = load_class_names(args.labels)
-    yolov7_main = YOLOv7_Main(args.model, args.det_thr, args.iou_thres)
+    yolov7_main = YOLOv7_Main(args.model, args.det_thr, args.iou_thres, img_size=parse_img_size(args.img_size))
+    logging.info(f"Detector input is {yolov7_main.size[0]}x{yolov7_main.size[1]}")
     mot_tracker = Sort(max_age=args.max_age,
         min_hits=args.min_hits,
-        iou_threshold=args.iou_thres) #create instance of the SORT tracker
+        iou_threshold=args.iou_threshold) #create instance of the SORT tracker
+    motion_estimator = None
+    if args.motion_compensation:
+        logging.info("Camera motion compensation is enabled")
+        motion_estimator = GlobalMotionEstimator(scale=args.motion_scale)
 
-    _, fps, width, height = get_stream_info(input_video_path)
-    if args.output_file != "":
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        # out_stream = cv2.VideoWriter(args.output_file, fourcc, fps, (int(width), int(height)), True)
-        out_stream = cv2.VideoWriter(args.output_file, fourcc, fps, (640, 640), True)
+    out_stream = None
+    if args.output_file != "" and info is not None:
+        # The validation video is of the letterboxed input of the detector
+        out_stream = open_output(args.output_file, info.fps, yolov7_main.size, args.encoder, args.crf, args.preset,
+            args.output_policy, args.output_every, args.pre_roll, args.post_roll, args.highlight_frames)
 
     class_names = load_class_names(args.labels)
-    traffic_counter = TrafficCounter(lanes, class_names)
-    with Camera(Path(input_video_path)) as camera:
-        for sample in camera.stream():
-            frame = sample.data
-            out_frame = cv2.resize(frame, (640, 640))
-
-            # Step: Detection of vehicles
-            detections = yolov7_main.run(frame)
-            results = np.asarray(detections[0].cpu().detach())
-
-            # Step: Update the trackers
-            if len(results) == 0:
-                logging.info("No detections")
-                # SORT recommends updating it even with no detections
-                trackers = mot_tracker.update()
-            else:
-                # for result in results:
-                #     result[0] = result[0] * width/640  ## x1
-                #     result[1] = result[1] * height/640  ## y1
-                #     result[2] = result[2] * width/640  ## x2
-                #     result[3] = result[3] * height/640  ## y2
-                # results[:, 2:4] += results[:, 0:2] #convert to [x1,y1,w,h] to [x1,y1,x2,y2]
-                det = results
-                trackers = mot_tracker.update(det)
-
-            # Step: Update the traffic counter for recognized tracks
-            traffic_counter.update(trackers)
-
-            # Step (optional): Visualize the result for validation
-            # Passing the trackers allows visualization of vehicles currently being tracked.
-            if args.output_file != "":
-                out_frame = traffic_counter.visualize(out_frame, trackers)
-                out_stream.write(cv2.cvtColor(out_frame, cv2.COLOR_RGB2BGR))
-            # break
-    if args.output_file != "":
-        out_stream.release()
-
-    with Plugin() as plugin:
-        total_count, count_per_lane = traffic_counter.report_results()
-        logging.info(f"Publishing total count: {total_count}")
-        plugin.publish("env.traffic.count.total", total_count, timestamp=timestamp)
+    traffic_counter = TrafficCounter(lanes, class_names, space=lanes_space)
+    profiler = Profiler()
+    detection_writer = None
+    if args.save_detections != "":
+        logging.info(f"Saving detections to {args.save_detections}")
+        detection_writer = DetectionWriter(args.save_detections)
+    def open_reader(path):
+        if args.decode_process:
+            # Imported only here, as shared memory needs Python 3.8
+            from transport import RingReader
+            return RingReader(path, args.ring_slots, info=info)
+        return None
 
-        for lane, count in count_per_lane.items():
-            logging.info(f"Publishing count for {lane}: {count}")
-            plugin.publish(f"env.traffic.count.{lane}", count, timestamp=timestamp)
+    if recorder is None:
+        process_video(input_video_path, yolov7_main, mot_tracker, traffic_counter, profiler,
+            motion_estimator=motion_estimator,
+            out_stream=out_stream,
+            detection_writer=detection_writer,
+            reader=open_reader(input_video_path))
+    else:
+        # Tracks and counts carry over from one segment to the next
+        frame_offset = 0
+        try:
+            for segment_path, _ in segments:
+                frame_offset += process_video(segment_path, yolov7_main, mot_tracker, traffic_counter, profiler,
+                    motion_estimator=motion_estimator,
+                    out_stream=out_stream,
+                    detection_writer=detection_writer,
+                    frame_offset=frame_offset,
+                    reader=open_reader(segment_path))
+        finally:
+            recorder.stop()
+        logging.info(f"Processed {frame_offset} frames of the capture")
+        input_video_path = args.stream
+    output_file = args.output_file if out_stream is not None else ""
+    if out_stream is not None:
+        out_stream.release()
+        if out_stream.written == 0:
+            logging.info("No frames were written by the output policy")
+            output_file = ""
+    if detection_writer is not None:
+        video = info._asdict() if info is not None else {}
+        detection_writer.close(timestamp=timestamp, input=str(input_video_path), **video)
+    if trace_sink is not None:
+        trace_sink.close()
+    if motion_estimator is not None:
+        mean_ms, max_ms = motion_estimator.report()
+        logging.info(f"Camera motion estimation took {mean_ms:.2f} ms per frame on average (max {max_ms:.2f} ms)")
 
-        if args.output_file != "":
-            logging.info(f"Uploading output video")
-            plugin.upload_file(args.output_file, timestamp=timestamp)
+    publish_results(traffic_counter, profiler, timestamp, output_file)
     return 0
 
 
@@ -294,6 +1049,8 @@ if __name__ == '__main__':
         help='Labels for detection')
     parser.add_argument("--detection-thres", dest='det_thr', type=float, default=0.5)
     parser.add_argument('--iou-thres', type=float, default=0.45, help='IOU threshold for NMS')
+    parser.add_argument('--img-size', dest='img_size', type=str, default='640',
+        help='Input size of the detector as WIDTHxHEIGHT, e.g. 640x384 for 16:9 frames, or a single number for a square; rounded up to multiples of 32')
 
     # Tracking
     parser.add_argument("--max-age",
@@ -304,11 +1061,36 @@ if __name__ == '__main__':
         type=int, default=3)
     parser.add_argument("--iou-threshold",
         help="Minimum IOU for match for Kalman Filter.", type=float, default=0.3)
+    parser.add_argument("--motion-compensation", dest='motion_compensation',
+        action='store_true',
+        help="Compensate the camera motion (e.g. pole sway) in the track predictions.")
+    parser.add_argument("--motion-scale", dest='motion_scale',
+        help="Downscale factor of frames for estimating the camera motion.", type=float, default=0.25)
 
     # Recording
     parser.add_argument(
         '--stream', action='store', default="", type=str,
         help='ID or name of a stream, e.g. sample')
+    parser.add_argument(
+        '--stream-cache', dest='stream_cache',
+        action='store', default=os.getenv('STREAM_CACHE', ''), type=str,
+        help='Path to the cache of the probed fps, size and codec of streams, shared by runs, on a volume that outlives the run; empty to probe every run')
+    parser.add_argument(
+        '--stream-cache-ttl', dest='stream_cache_ttl',
+        action='store', default=3600., type=float,
+        help='Seconds before the cached info of a stream is probed again')
+    parser.add_argument(
+        '--capture-dir', dest='capture_dir',
+        action='store', default="", type=str,
+        help='Directory, e.g. /dev/shm/trafficcounter, to capture the stream into as segments that are processed while the capture goes on')
+    parser.add_argument(
+        '--segment-duration', dest='segment_duration',
+        action='store', default=5., type=float,
+        help='Duration of a capture segment in seconds')
+    parser.add_argument(
+        '--segment-wrap', dest='segment_wrap',
+        action='store', default=10, type=int,
+        help='Number of capture segment files that are reused in a ring')
     parser.add_argument(
         '--duration', dest='duration',
         action='store', default=10., type=float,
@@ -327,13 +1109,90 @@ if __name__ == '__main__':
         '--lanes', dest='lanes',
         action='store', type=str, default=os.getenv('LANES', ''),
         help='A string of coordinations of target lanes in json.')
+    parser.add_argument(
+        '--decode-process', dest='decode_process',
+        action='store_true',
+        help='Decode the video in another process that passes frames through shared memory; needs Python 3.8 or later')
+    parser.add_argument(
+        '--ring-slots', dest='ring_slots',
+        action='store', default=8, type=int,
+        help='Number of frames in shared memory between the decoder process and detection')
     
+    # Multiple cameras
+    parser.add_argument(
+        '--cameras-file', dest='cameras_file',
+        action='store', type=Path,
+        help='Path to camera configurations in json to process multiple cameras with one detector')
+    parser.add_argument(
+        '--cameras', dest='cameras',
+        action='store', type=str, default=os.getenv('CAMERAS', ''),
+        help='A string of camera configurations in json.')
+
+    # Tracing
+    parser.add_argument(
+        '--trace', dest='trace',
+        action='store', type=str, default='',
+        help='Comma-separated subsystems to trace: detector, sort, counter')
+    parser.add_argument(
+        '--trace-file', dest='trace_file',
+        action='store', type=str, default='',
+        help='Path to write trace records in JSON lines. Records are kept in memory if not given')
+    parser.add_argument(
+        '--trace-sample', dest='trace_sample',
+        action='store', type=int, default=1,
+        help='Trace every Nth frame')
+
+    # Detection cache
+    parser.add_argument(
+        '--save-detections', dest='save_detections',
+        action='store', type=str, default='',
+        help='Path to a directory to save the detections of each frame for replay')
+    parser.add_argument(
+        '--replay-detections', dest='replay_detections',
+        action='store', type=str, default='',
+        help='Path to a directory of saved detections to run tracking and counting on, without detection')
+
     # Output
     parser.add_argument(
         '--output-file', dest='output_file',
         action='store', type=str, default='',
         help='Path to output video file for validation')
+    parser.add_argument(
+        '--encoder', dest='encoder',
+        action='store', type=str, default='ffmpeg', choices=['ffmpeg', 'opencv'],
+        help='Encoder of the output video: ffmpeg encodes H.264 in the background, opencv encodes MPEG-4 inline')
+    parser.add_argument(
+        '--crf', dest='crf',
+        action='store', type=int, default=28,
+        help='Constant rate factor of H.264; higher is smaller')
+    parser.add_argument(
+        '--preset', dest='preset',
+        action='store', type=str, default='veryfast',
+        help='Preset of H.264 encoding speed, e.g. ultrafast, veryfast, medium')
+    parser.add_argument(
+        '--output-policy', dest='output_policy',
+        action='store', type=str, default='all', choices=['all', 'every', 'events', 'highlights'],
+        help='Frames to write: all, every Nth, around count line crossings, or around crossings up to a fixed length')
+    parser.add_argument(
+        '--output-every', dest='output_every',
+        action='store', type=int, default=10,
+        help='N of the every policy')
+    parser.add_argument(
+        '--pre-roll', dest='pre_roll',
+        action='store', type=int, default=15,
+        help='Frames before a crossing to write in the events and highlights policies')
+    parser.add_argument(
+        '--post-roll', dest='post_roll',
+        action='store', type=int, default=15,
+        help='Frames after a crossing to write in the events and highlights policies')
+    parser.add_argument(
+        '--highlight-frames', dest='highlight_frames',
+        action='store', type=int, default=300,
+        help='Maximum number of frames of the highlights policy')
     args = parser.parse_args()
+    if args.decode_process and sys.version_info < (3, 8):
+        # Rather than after recording, when the decoder needs shared memory
+        parser.error("--decode-process needs Python 3.8 or later for shared memory")
 
     logging.basicConfig(
         level=logging.INFO,
@@ -0,0 +1,215 @@
+""" Batch reprocessing of recorded clips.
+
+Clips are taken from a directory of .mp4 files or a manifest listing one clip
+per line. A pool of worker processes each load YOLOv7 once and take clips from
+a shared queue, so the model is loaded once per worker rather than once per
+clip. The counts of each clip are appended to a JSON lines results file as soon
+as the clip is done; clips already in the results file are skipped, so a batch
+resumes where it stopped after a crash.
+
+A clip uses clip.lanes.json next to it if it exists, or --lanes-file otherwise.
+
+    # One worker per GPU
+    python3 batch.py --input data/ --lanes-file lanes.json --devices cuda:0 cuda:1 --results results.jsonl
+
+    # Four CPU workers with two threads each
+    python3 batch.py --input manifest.txt --lanes-file lanes.json --devices cpu --workers 4 --threads 2
+
+    # Decode each clip in chunks by 8 decoder processes per worker, for long clips on many cores
+    python3 batch.py --input data/ --lanes-file lanes.json --devices cuda:0 --decode-workers 8
+"""
+import argparse
+import json
+import logging
+import multiprocessing as mp
+import os
+import queue
+import time
+from pathlib import Path
+
+import cv2
+import torch
+
+from app import TrafficCounter, load_class_names, parse_img_size, process_video
+from coordinates import load_lanes_config
+from models.sort import Sort
+from profiling import Profiler
+
+
+def list_clips(input_path):
+    """ list_clips returns the clips of a directory or a manifest
+    """
+    input_path = Path(input_path)
+    if input_path.is_dir():
+        return sorted(str(path) for path in input_path.glob("*.mp4"))
+    clips = []
+    for line in input_path.read_text().splitlines():
+        line = line.strip()
+        if line != "" and not line.startswith("#"):
+            clips.append(line)
+    return clips
+
+
+def load_results(results_path):
+    """ load_results returns the clips that already have results
+    """
+    done = set()
+    if not Path(results_path).exists():
+        return done
+    with open(results_path) as fp:
+        for line in fp:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut short by a crash; the clip runs again
+                continue
+            if "error" not in result:
+                done.add(result["clip"])
+    return done
+
+
+def counts_to_dict(counts):
+    return {
+        "total": counts.total,
+        "per_lane": counts.per_lane,
+        "per_class": counts.per_class,
+        "per_direction": counts.per_direction,
+        "per_lane_direction": {f"{lane}.{direction}": count for (lane, direction), count in counts.per_lane_direction.items()},
+        "per_movement": {f"{origin}.{destination}": count for (origin, destination), count in counts.per_movement.items()},
+    }
+
+
+def load_detector(args, device):
+    from models.yolov7 import YOLOv7_Main
+    return YOLOv7_Main(args.model, args.det_thr, args.iou_thres, device=device, img_size=parse_img_size(args.img_size))
+
+
+def process_clip(clip, detector, class_names, args, decode_pool=None):
+    lanes_path = Path(clip).with_suffix(".lanes.json")
+    if not lanes_path.exists():
+        lanes_path = args.lanes_file
+    lanes, lanes_space = load_lanes_config(json.loads(Path(lanes_path).read_text()))
+    mot_tracker = Sort(max_age=args.max_age, min_hits=args.min_hits, iou_threshold=args.iou_threshold)
+    traffic_counter = TrafficCounter(lanes, class_names, space=lanes_space)
+    profiler = Profiler()
+    start = time.monotonic()
+    reader = decode_pool.reader(clip) if decode_pool is not None else None
+    process_video(clip, detector, mot_tracker, traffic_counter, profiler, reader=reader)
+    elapsed = time.monotonic() - start
+    frames = profiler.stage("frame").count
+    return {
+        "clip": clip,
+        "lanes": str(lanes_path),
+        "frames": frames,
+        "elapsed": elapsed,
+        "fps": frames / elapsed if elapsed > 0 else 0.,
+        "counts": counts_to_dict(traffic_counter.report_results()),
+    }
+
+
+def worker(device, tasks, results, args):
+    """ worker loads the detector on the device once and processes clips from tasks until None
+    """
+    torch.set_num_threads(args.threads)
+    cv2.setNumThreads(args.threads)
+    detector = load_detector(args, device)
+    class_names = load_class_names(args.labels)
+    decode_pool = None
+    if args.decode_workers > 0:
+        # Imported only here, as shared memory needs Python 3.8
+        from decoding import DecodePool
+        decode_pool = DecodePool(args.decode_workers)
+    while True:
+        clip = tasks.get()
+        if clip is None:
+            if decode_pool is not None:
+                decode_pool.shutdown()
+            return
+        try:
+            result = process_clip(clip, detector, class_names, args, decode_pool)
+        except Exception as e:
+            result = {"clip": clip, "error": f"{type(e).__name__}: {e}"}
+        result["device"] = device
+        results.put(result)
+
+
+def main(args):
+    clips = list_clips(args.input)
+    done = load_results(args.results)
+    pending = [clip for clip in clips if clip not in done]
+    logging.info(f"{len(clips)} clips, {len(clips) - len(pending)} already done, {len(pending)} to process")
+    if len(pending) == 0:
+        return 0
+
+    # CUDA does not survive fork; start workers fresh
+    ctx = mp.get_context("spawn")
+    tasks = ctx.Queue()
+    results = ctx.Queue()
+    devices = [device for device in args.devices for _ in range(args.workers)]
+    for clip in pending:
+        tasks.put(clip)
+    for _ in devices:
+        tasks.put(None)
+    # Daemon processes cannot start the processes of a decode pool
+    workers = [ctx.Process(target=worker, args=(device, tasks, results, args), daemon=args.decode_workers == 0) for device in devices]
+    for p in workers:
+        p.start()
+    logging.info(f"Started {len(workers)} workers on {', '.join(args.devices)}")
+
+    failed = 0
+    with open(args.results, "a") as fp:
+        for i in range(len(pending)):
+            while True:
+                try:
+                    result = results.get(timeout=5.)
+                    break
+                except queue.Empty:
+                    if not any(p.is_alive() for p in workers):
+                        logging.error("All workers have exited; run again to resume")
+                        return -1
+            # Each result is on disk before the next one so that a crash loses at most the clips in flight
+            fp.write(json.dumps(result) + "\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+            if "error" in result:
+                failed += 1
+                logging.error(f"[{i + 1}/{len(pending)}] {result['clip']}: {result['error']}")
+            else:
+                logging.info(f"[{i + 1}/{len(pending)}] {result['clip']}: {result['counts']['total']} vehicles at {result['fps']:.1f} FPS on {result['device']}")
+
+    for p in workers:
+        p.join()
+    return 0 if failed == 0 else -1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Batch reprocessing of recorded clips')
+    parser.add_argument('--input', type=Path, required=True, help='Directory of .mp4 clips or a manifest of one clip per line')
+    parser.add_argument('--results', type=Path, default=Path('results.jsonl'), help='Path to the results in JSON lines')
+    parser.add_argument('--lanes-file', dest='lanes_file', type=Path, default=None,
+        help='Lanes config for clips without clip.lanes.json')
+    parser.add_argument('--devices', nargs='+', default=['cuda' if torch.cuda.is_available() else 'cpu'],
+        help='Devices to run workers on, e.g. cuda:0 cuda:1 or cpu')
+    parser.add_argument('--workers', type=int, default=1, help='Number of workers per device')
+    parser.add_argument('--threads', type=int, default=1, help='Number of threads per worker')
+    parser.add_argument('--decode-workers', type=int, default=0,
+        help='Number of processes per worker that decode chunks of a clip in parallel; 0 decodes in the worker. Needs Python 3.8 or later')
+
+    # Detection
+    parser.add_argument('--model', type=Path, default=Path('model.pt'))
+    parser.add_argument('--labels', type=Path, default=Path('coco.names'))
+    parser.add_argument("--detection-thres", dest='det_thr', type=float, default=0.5)
+    parser.add_argument('--iou-thres', type=float, default=0.45, help='IOU threshold for NMS')
+    parser.add_argument('--img-size', type=str, default='640', help='Input size of the detector as WIDTHxHEIGHT')
+
+    # Tracking
+    parser.add_argument('--max-age', type=int, default=15)
+    parser.add_argument('--min-hits', type=int, default=3)
+    parser.add_argument('--iou-threshold', type=float, default=0.3)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(message)s',
+        datefmt='%Y/%m/%d %H:%M:%S')
+    exit(main(args))
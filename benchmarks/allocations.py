@@ -0,0 +1,81 @@
+""" Host memory allocated per frame to prepare the input of the detector.
+
+Before, the frame was resized for visualization and again by the detector,
+which then made a float64 copy of it. Now, without output, the frame is only
+letterboxed by the detector, which moves it into a reused input tensor as
+uint8. Allocations are traced with tracemalloc, which sees NumPy and OpenCV
+arrays but not the allocator of PyTorch, so the half tensor allocated per
+frame before is not counted; the figures of before are a lower bound.
+
+    python3 -m benchmarks.allocations --resolution 1920x1080
+"""
+import argparse
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+import torch
+
+from models.yolov7 import prepare_input
+from benchmarks.memory import reset_peak
+
+
+def before(frame, size, device):
+    out_frame = cv2.resize(frame, size)
+    # YOLOv7_Main.prepare_input as it was
+    sized = cv2.resize(frame, size)
+    image = sized / 255.0
+    image = image.transpose((2, 0, 1))
+    image = torch.from_numpy(image).to(device).half()
+    image = image.unsqueeze(0)
+    return out_frame, image
+
+
+class After:
+    def __init__(self, size, device):
+        self.size = size
+        self.input = torch.empty((1, 3, size[1], size[0]), dtype=torch.half, device=device)
+
+    def __call__(self, frame, size, device):
+        image, _, _ = prepare_input([frame], size, self.input)
+        return None, image
+
+
+def measure(fn, frames, size, device):
+    # Warm up so that buffers reused over frames are allocated before measuring
+    fn(frames[0], size, device)
+    peaks = []
+    start = time.monotonic()
+    tracemalloc.start()
+    for frame in frames:
+        current = reset_peak()
+        fn(frame, size, device)
+        _, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - current)
+    tracemalloc.stop()
+    elapsed = time.monotonic() - start
+    return np.mean(peaks), elapsed / len(frames)
+
+
+def main(args):
+    width, height = [int(v) for v in args.resolution.split("x")]
+    size = (640, 640)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(0, 255, (height, width, 3), dtype=np.uint8) for _ in range(args.frames)]
+
+    print(f"{args.frames} frames of {args.resolution} to {size[0]}x{size[1]} on {device}")
+    for name, fn in [("before", before), ("after", After(size, device))]:
+        allocated, per_frame = measure(fn, frames, size, device)
+        print(f"{name:>6}: {allocated / 2**20:6.2f} MiB allocated per frame, {per_frame * 1e3:.2f} ms per frame")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Allocations per frame of preparing the detector input')
+    parser.add_argument('--resolution', default='1920x1080', help='WIDTHxHEIGHT of the frames')
+    parser.add_argument('--frames', type=int, default=100)
+    args = parser.parse_args()
+
+    exit(main(args))
@@ -0,0 +1,66 @@
+""" Decode throughput of waggle's Camera against parallel decoding in chunks.
+
+Each reader decodes the whole clip and only touches the frames, so the numbers
+are the ceiling that decoding puts on process_video. The parallel reader runs
+in a pool of each size in --workers, warmed up by one read first so that the
+start of the decoder processes is not counted.
+
+    python3 -m benchmarks.decode --clip data/archive.mp4 --workers 2 4 8
+"""
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+
+from waggle.data.vision import Camera
+
+from decoding import DecodePool
+from benchmarks.synthetic import generate_clip
+
+
+def read_all(reader):
+    count = 0
+    start = time.monotonic()
+    with reader as camera:
+        for sample in camera.stream():
+            sample.data[0, 0]
+            count += 1
+    return count, time.monotonic() - start
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.clip is not None:
+            clip = args.clip
+        else:
+            clip = Path(workdir) / "clip.mp4"
+            generate_clip(clip, 1920, 1080, 15, args.duration, 4, 0.5, 0)
+
+        frames, elapsed = read_all(Camera(clip))
+        results = [{"reader": "camera", "workers": 1, "frames": frames, "fps": frames / elapsed}]
+        for workers in args.workers:
+            with DecodePool(workers) as pool:
+                read_all(pool.reader(clip, args.chunk_duration))
+                frames, elapsed = read_all(pool.reader(clip, args.chunk_duration))
+            results.append({"reader": "parallel", "workers": workers, "frames": frames, "fps": frames / elapsed})
+
+    print("| reader | workers | frames | FPS |")
+    print("|---|---|---|---|")
+    for r in results:
+        print(f"| {r['reader']} | {r['workers']} | {r['frames']} | {r['fps']:.1f} |")
+    if args.output is not None:
+        args.output.write_text(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Decode throughput of Camera against parallel decoding in chunks')
+    parser.add_argument('--clip', type=Path, default=None, help='Clip to decode; a synthetic 1080p clip if not given')
+    parser.add_argument('--workers', type=int, nargs='+', default=[2, 4], help='Sizes of the decode pool')
+    parser.add_argument('--chunk-duration', type=float, default=2., help='Minimum length of a chunk in seconds')
+    parser.add_argument('--duration', type=float, default=20., help='Length of the synthetic clip in seconds')
+    parser.add_argument('--output', type=Path, default=None, help='Path to the JSON report')
+    args = parser.parse_args()
+
+    exit(main(args))
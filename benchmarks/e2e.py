@@ -0,0 +1,188 @@
+""" End-to-end benchmark of the application on synthetic traffic clips.
+
+For each resolution and density, a deterministic clip is generated and run
+through app.process_video, the same path app.main takes. The report records
+FPS, the latency of each stage, peak RSS and the count error against the
+ground truth of the clip. Without --model, a color-threshold detector stands
+in for YOLOv7 so that the benchmark runs offline on a CPU-only machine. Each
+case runs in a fresh process, so that its peak RSS is not that of an earlier
+case; the clip is generated beforehand in the parent.
+
+    python3 -m benchmarks.e2e --output report.json
+"""
+import argparse
+import json
+import multiprocessing as mp
+import platform
+import tempfile
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+import torch
+
+from app import TrafficCounter, load_class_names, parse_img_size, process_video
+from models.sort import Sort
+from profiling import Profiler
+from sweep import count_error
+from encoder import open_output
+from benchmarks.memory import peak_rss_mb
+from benchmarks.synthetic import generate_clip
+
+
+class ColorDetector:
+    """ ColorDetector finds the saturated rectangles of synthetic clips.
+    It follows the interface of YOLOv7_Main and returns boxes in the coordinates of the frames as cars.
+    The frames are resized to size for thresholding, so size trades accuracy for speed as for YOLOv7.
+    """
+    def __init__(self, size=(640, 640), min_area=100):
+        self.size = size
+        self.min_area = min_area
+        self.frame_shapes = []
+        self.ratio_pads = []
+        self.resized = []
+
+    def infer(self, frame):
+        return self.infer_batch([frame])
+
+    def infer_batch(self, frames):
+        masks = []
+        self.resized = []
+        self.ratio_pads = []
+        for frame in frames:
+            sized = frame
+            if frame.shape[:2] != (self.size[1], self.size[0]):
+                sized = cv2.resize(frame, self.size)
+            saturation = cv2.cvtColor(sized, cv2.COLOR_RGB2HSV)[:, :, 1]
+            masks.append(saturation > 80)
+            # Stretched rather than letterboxed, so there is no padding
+            self.resized.append(sized)
+            self.ratio_pads.append(((self.size[0] / frame.shape[1], self.size[1] / frame.shape[0]), (0, 0)))
+        self.frame_shapes = [frame.shape[:2] for frame in frames]
+        return np.stack(masks)
+
+    def suppress(self, masks):
+        detections = []
+        min_area = self.min_area * self.size[0] * self.size[1] / 640**2
+        for mask, (height, width) in zip(masks, self.frame_shapes):
+            n, _, stats, _ = cv2.connectedComponentsWithStats(mask.astype(np.uint8))
+            boxes = []
+            for l, t, w, h, area in stats[1:n]:
+                if area >= min_area:
+                    boxes.append([l, t, l + w, t + h, 0.9, 2])
+            boxes = torch.tensor(boxes, dtype=torch.float32).reshape(-1, 6)
+            boxes[:, [0, 2]] *= width / self.size[0]
+            boxes[:, [1, 3]] *= height / self.size[1]
+            detections.append(boxes)
+        return detections
+
+
+def load_detector(args):
+    if args.model is not None:
+        from models.yolov7 import YOLOv7_Main
+        return YOLOv7_Main(args.model, args.det_thr, args.iou_thres, img_size=parse_img_size(args.img_size))
+    return ColorDetector()
+
+
+def run_case(clip, lanes, num_frames, args, workdir, results):
+    detector = load_detector(args)
+    class_names = load_class_names(args.labels)
+    mot_tracker = Sort(max_age=args.max_age, min_hits=args.min_hits, iou_threshold=args.iou_threshold)
+    traffic_counter = TrafficCounter(lanes, class_names)
+    profiler = Profiler()
+    out_stream = None
+    if args.with_output:
+        out_stream = open_output(Path(workdir) / "out.mp4", args.fps, detector.size, args.encoder, policy=args.output_policy)
+
+    start = time.monotonic()
+    process_video(clip, detector, mot_tracker, traffic_counter, profiler, out_stream=out_stream)
+    elapsed = time.monotonic() - start
+    if out_stream is not None:
+        out_stream.release()
+
+    counts = traffic_counter.report_results()
+    results.send({
+        "frames": num_frames,
+        "elapsed": elapsed,
+        "fps": num_frames / elapsed,
+        "stages": profiler.summary(),
+        "peak_rss_mb": peak_rss_mb(),
+        "counts": counts,
+    })
+
+
+def run_case_process(args, width, height, density, workdir):
+    clip = Path(workdir) / f"clip_{width}x{height}_{density}.mp4"
+    lanes, ground_truth, num_frames = generate_clip(
+        clip, width, height, args.fps, args.duration, args.lanes, density, args.seed)
+
+    # A fresh process, as the peak RSS of a process never goes down
+    ctx = mp.get_context("spawn")
+    results_recv, results_send = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=run_case, args=(clip, lanes, num_frames, args, workdir, results_send))
+    process.start()
+    # The pipe closes if the case fails before sending its result
+    results_send.close()
+    result = results_recv.recv()
+    process.join()
+    counts = result.pop("counts")
+    return {
+        "resolution": f"{width}x{height}",
+        "density": density,
+        **result,
+        "ground_truth": ground_truth,
+        "counts": {"total": counts.total, "per_lane": counts.per_lane, "per_direction": counts.per_direction},
+        "error": count_error(counts, ground_truth),
+    }
+
+
+def main(args):
+    report = {
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "detector": "yolov7" if args.model is not None else "color",
+        "cases": [],
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        for resolution in args.resolutions:
+            width, height = [int(v) for v in resolution.split("x")]
+            for density in args.densities:
+                result = run_case_process(args, width, height, density, workdir)
+                report["cases"].append(result)
+                print(f"{result['resolution']} density {density}: {result['fps']:.1f} FPS, "
+                      f"count {result['counts']['total']}/{result['ground_truth']['total']}, "
+                      f"peak RSS {result['peak_rss_mb']:.0f} MiB")
+
+    args.output.write_text(json.dumps(report, indent=2))
+    print(f"Report written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='End-to-end benchmark on synthetic traffic')
+    parser.add_argument('--output', type=Path, default=Path('benchmark.json'), help='Path to the JSON report')
+    parser.add_argument('--resolutions', nargs='+', default=['1280x720', '1920x1080'])
+    parser.add_argument('--densities', type=float, nargs='+', default=[0.25, 0.5, 1.0],
+        help='Vehicles per second per lane')
+    parser.add_argument('--duration', type=float, default=20., help='Length of each clip in seconds')
+    parser.add_argument('--fps', type=float, default=15)
+    parser.add_argument('--lanes', type=int, default=4, help='Number of lanes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--with-output', dest='with_output', action='store_true',
+        help='Also render and encode the validation video')
+    parser.add_argument('--encoder', default='ffmpeg', choices=['ffmpeg', 'opencv'], help='Encoder of the validation video')
+    parser.add_argument('--output-policy', default='all', choices=['all', 'every', 'events', 'highlights'],
+        help='Frames of the validation video to write')
+
+    parser.add_argument('--model', type=Path, default=None, help='YOLOv7 weights; a color detector is used if not given')
+    parser.add_argument('--labels', default='coco.names')
+    parser.add_argument('--detection-thres', dest='det_thr', type=float, default=0.5)
+    parser.add_argument('--iou-thres', type=float, default=0.45)
+    parser.add_argument('--img-size', type=str, default='640', help='Input size of the detector as WIDTHxHEIGHT')
+    parser.add_argument('--max-age', type=int, default=15)
+    parser.add_argument('--min-hits', type=int, default=3)
+    parser.add_argument('--iou-threshold', type=float, default=0.3)
+    args = parser.parse_args()
+
+    exit(main(args))
@@ -0,0 +1,95 @@
+""" FPS and count accuracy per input size of the detector.
+
+Each size runs the same reference clip through app.process_video and the
+result is printed as a table, from which a node can pick its operating point.
+The reference clip is a labeled clip (clip.mp4 with clip.lanes.json and
+clip.truth.json next to it, as benchmarks.synthetic writes) or a synthetic
+clip generated on the fly. Without --model, the color detector of the
+end-to-end benchmark stands in for YOLOv7.
+
+    python3 -m benchmarks.img_size --model model.pt --clip data/reference.mp4 --sizes 320 416x256 640x384 640
+"""
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+
+from app import TrafficCounter, load_class_names, parse_img_size, process_video
+from coordinates import load_lanes_config
+from models.sort import Sort
+from profiling import Profiler
+from sweep import count_error
+from benchmarks.synthetic import generate_clip
+from benchmarks.e2e import ColorDetector
+
+
+def run_size(clip, lanes, ground_truth, class_names, size, args):
+    if args.model is not None:
+        from models.yolov7 import YOLOv7_Main
+        detector = YOLOv7_Main(args.model, args.det_thr, args.iou_thres, img_size=size)
+        size = detector.size
+    else:
+        detector = ColorDetector(size)
+    mot_tracker = Sort(max_age=args.max_age, min_hits=args.min_hits, iou_threshold=args.iou_threshold)
+    lanes, lanes_space = load_lanes_config(lanes)
+    traffic_counter = TrafficCounter(lanes, class_names, space=lanes_space)
+    profiler = Profiler()
+    start = time.monotonic()
+    process_video(clip, detector, mot_tracker, traffic_counter, profiler)
+    elapsed = time.monotonic() - start
+    counts = traffic_counter.report_results()
+    stages = profiler.summary()
+    return {
+        "size": f"{size[0]}x{size[1]}",
+        "fps": profiler.stage("frame").count / elapsed,
+        "detect_p50": stages["detect"]["p50"],
+        "count": counts.total,
+        "truth": ground_truth["total"],
+        "error": count_error(counts, ground_truth),
+    }
+
+
+def main(args):
+    class_names = load_class_names(args.labels)
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.clip is not None:
+            clip = args.clip
+            lanes = json.loads(clip.with_suffix(".lanes.json").read_text())
+            ground_truth = json.loads(clip.with_suffix(".truth.json").read_text())
+        else:
+            clip = Path(workdir) / "reference.mp4"
+            lanes, ground_truth, _ = generate_clip(clip, 1280, 720, 15, args.duration, 4, args.density, args.seed)
+
+        results = [run_size(clip, lanes, ground_truth, class_names, parse_img_size(size), args) for size in args.sizes]
+
+    print("| size | FPS | detect p50 (ms) | count | error | per-lane error |")
+    print("|---|---|---|---|---|---|")
+    for r in results:
+        print(f"| {r['size']} | {r['fps']:.1f} | {r['detect_p50'] * 1e3:.1f} | {r['count']}/{r['truth']} | "
+              f"{r['error']['total_relative'] * 100:+.1f}% | {r['error']['per_lane_absolute']} |")
+    if args.output is not None:
+        args.output.write_text(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='FPS and count accuracy per input size of the detector')
+    parser.add_argument('--sizes', nargs='+', default=['320', '416x256', '640x384', '640'],
+        help='Input sizes as WIDTHxHEIGHT or a single number for a square')
+    parser.add_argument('--clip', type=Path, default=None, help='Labeled reference clip; a synthetic clip if not given')
+    parser.add_argument('--output', type=Path, default=None, help='Path to the JSON report')
+    parser.add_argument('--duration', type=float, default=20., help='Length of the synthetic clip in seconds')
+    parser.add_argument('--density', type=float, default=0.5, help='Vehicles per second per lane of the synthetic clip')
+    parser.add_argument('--seed', type=int, default=0)
+
+    parser.add_argument('--model', type=Path, default=None, help='YOLOv7 weights; a color detector is used if not given')
+    parser.add_argument('--labels', default='coco.names')
+    parser.add_argument('--detection-thres', dest='det_thr', type=float, default=0.5)
+    parser.add_argument('--iou-thres', type=float, default=0.45)
+    parser.add_argument('--max-age', type=int, default=15)
+    parser.add_argument('--min-hits', type=int, default=3)
+    parser.add_argument('--iou-threshold', type=float, default=0.3)
+    args = parser.parse_args()
+
+    exit(main(args))
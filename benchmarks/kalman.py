@@ -0,0 +1,77 @@
+""" Per-track microbenchmark of the Kalman step used by KalmanBoxTracker.
+It checks that KalmanBoxFilter matches filterpy's KalmanFilter configured
+the same way and times one predict/update cycle of each.
+
+    python3 -m benchmarks.kalman --steps 10000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from models.kalman import KalmanBoxFilter
+from models.sort import convert_bbox_to_z
+
+
+R_DIAG, Q_POS, Q_VEL = 0.15, 0.0106123, 0.016327
+
+
+def make_filterpy_filter(dt):
+    from filterpy.kalman import KalmanFilter
+    kf = KalmanFilter(dim_x=7, dim_z=4)
+    kf.F = np.eye(7, dtype=float)
+    kf.F[0, 4] = kf.F[1, 5] = kf.F[2, 6] = dt
+    kf.H = np.eye(7, dtype=float)[:4]
+    np.fill_diagonal(kf.R, R_DIAG)
+    np.fill_diagonal(kf.Q[:3, :3], Q_POS)
+    np.fill_diagonal(kf.Q[3:, 3:], Q_VEL)
+    np.fill_diagonal(kf.P[:4, :4], 1.0)
+    np.fill_diagonal(kf.P[4:, 4:], 0.96)
+    return kf
+
+
+def make_measurements(steps, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(steps)
+    boxes = np.empty((steps, 4))
+    boxes[:, 0] = 100 + 2.0 * t + rng.normal(0, 2, steps)
+    boxes[:, 1] = 200 + 0.5 * t + rng.normal(0, 2, steps)
+    boxes[:, 2] = boxes[:, 0] + 60 + rng.normal(0, 2, steps)
+    boxes[:, 3] = boxes[:, 1] + 40 + rng.normal(0, 2, steps)
+    return [convert_bbox_to_z(box) for box in boxes]
+
+
+def run(kf, measurements):
+    kf.x[:4] = measurements[0]
+    start = time.perf_counter()
+    for z in measurements[1:]:
+        kf.predict()
+        kf.update(z)
+    return (time.perf_counter() - start) / (len(measurements) - 1)
+
+
+def main(args):
+    measurements = make_measurements(args.steps)
+    for dt in [0., 1.]:
+        ours = KalmanBoxFilter(R_DIAG, Q_POS, Q_VEL, P_pos=1.0, P_vel=0.96, dt=dt)
+        ours_time = run(ours, measurements)
+        print(f"dt={dt:g} KalmanBoxFilter: {ours_time * 1e6:.2f} us per step")
+        try:
+            reference = make_filterpy_filter(dt)
+        except ImportError:
+            print("filterpy is not installed; skipping the comparison")
+            continue
+        reference_time = run(reference, measurements)
+        np.testing.assert_allclose(ours.x, reference.x, rtol=1e-6, atol=1e-6)
+        np.testing.assert_allclose(ours.P, reference.P, rtol=1e-6, atol=1e-9)
+        print(f"dt={dt:g} filterpy KalmanFilter: {reference_time * 1e6:.2f} us per step "
+              f"({reference_time / ours_time:.1f}x slower, states match)")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Kalman step microbenchmark')
+    parser.add_argument('--steps', type=int, default=10000, help='Number of predict/update steps per track')
+    args = parser.parse_args()
+
+    exit(main(args))
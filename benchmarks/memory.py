@@ -0,0 +1,27 @@
+""" Memory measurements shared by the benchmarks.
+"""
+import resource
+import sys
+import tracemalloc
+
+
+def peak_rss_mb():
+    """ peak_rss_mb returns the peak RSS of the calling process in MiB. It is the high-water mark
+    over the life of the process, so a case whose peak is reported runs in a fresh process.
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak():
+    """ reset_peak starts a new peak of the memory traced by tracemalloc and returns the memory
+    traced now, so that the peak less it is what was allocated since. tracemalloc.reset_peak is
+    new in Python 3.9; before it, tracing restarts, which forgets the memory traced so far.
+    """
+    if sys.version_info >= (3, 9):
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.stop()
+        tracemalloc.start()
+    current, _ = tracemalloc.get_traced_memory()
+    return current
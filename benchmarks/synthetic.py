@@ -0,0 +1,156 @@
+""" Deterministic synthetic traffic clips with known ground truth.
+
+Vehicles are drawn as colored rectangles on a gray road, moving along lane
+polylines at constant speeds. Lanes are defined in the 640x640 space that
+the lanes config of the application uses and scaled to the clip resolution.
+
+    python3 -m benchmarks.synthetic --output clip.mp4 --resolution 1280x720
+"""
+import argparse
+import json
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+
+MODEL_SIZE = 640
+COUNT_Y = 320
+
+
+def make_lanes(num_lanes):
+    """ make_lanes returns the lanes config with a horizontal count line in the middle.
+    Lanes on the left carry vehicles downward (inbound) and those on the right upward (outbound).
+    """
+    lanes = [{"name": "count", "points": [[0, COUNT_Y], [MODEL_SIZE, COUNT_Y]]}]
+    spacing = MODEL_SIZE / num_lanes
+    for i in range(num_lanes):
+        x = spacing * (i + 0.5)
+        # A slight bend keeps the lanes from being trivially vertical
+        bend = (i - (num_lanes - 1) / 2) * 6
+        lanes.append({
+            "name": f"lane{i}",
+            "points": [[x, 0], [x + bend, COUNT_Y], [x + 2 * bend, MODEL_SIZE]],
+        })
+    return lanes
+
+
+def lane_position(points, s):
+    """ lane_position returns the point at arc length s along the polyline
+    """
+    points = np.asarray(points, dtype=float)
+    lengths = np.linalg.norm(np.diff(points, axis=0), axis=1)
+    for i, length in enumerate(lengths):
+        if s <= length or i == len(lengths) - 1:
+            return points[i] + (points[i + 1] - points[i]) * (s / length)
+        s -= length
+
+
+class SyntheticVehicle:
+    def __init__(self, lane, downward, start_frame, speed, size, color):
+        self.lane = lane
+        self.downward = downward
+        self.start_frame = start_frame
+        self.speed = speed
+        self.size = size
+        self.color = color
+
+    def position(self, frame, points, length):
+        """ position returns the center of the vehicle in the model space,
+        or None if it is not on the road
+        """
+        s = (frame - self.start_frame) * self.speed - self.size[1]
+        if s < -self.size[1] or s > length + self.size[1]:
+            return None
+        if not self.downward:
+            s = length - s
+        return lane_position(points, np.clip(s, 0, length))
+
+    def crossing_frame(self, points, length):
+        """ crossing_frame returns the frame at which the reference point of the vehicle,
+        the middle of the lower half of its box, crosses the count line
+        """
+        # The reference point is a quarter of the height below the center
+        offset = self.size[1] / 4
+        target = COUNT_Y - offset if self.downward else length - (COUNT_Y - offset)
+        return self.start_frame + (target + self.size[1]) / self.speed
+
+
+def generate_clip(path, width=1280, height=720, fps=15, duration=20., num_lanes=4, density=0.5, seed=0):
+    """ generate_clip writes a clip and returns the lanes config and the ground truth.
+    density is the mean number of vehicles per second per lane.
+    """
+    rng = np.random.default_rng(seed)
+    lanes = make_lanes(num_lanes)
+    num_frames = int(duration * fps)
+
+    vehicles = []
+    for i, lane in enumerate(lanes[1:]):
+        downward = i < num_lanes / 2
+        # Vehicles in a lane share the speed so that they never run into each other
+        speed = rng.uniform(2, 5)  # model pixels per frame
+        frame = rng.uniform(0, fps / max(density, 1e-6))
+        while frame < num_frames:
+            size = (rng.uniform(50, 80), rng.uniform(40, 64))
+            color = tuple(int(c) for c in rng.choice([[220, 40, 40], [40, 200, 60], [40, 80, 220], [230, 200, 30]]))
+            vehicles.append(SyntheticVehicle(lane, downward, frame, speed, size, color))
+            # Keep a safe headway so that vehicles in a lane do not overlap
+            frame += max(rng.exponential(fps / max(density, 1e-6)), (2 * 64 + 30) / speed)
+
+    ground_truth = {"total": 0, "per_lane": {}, "per_direction": {}}
+    lane_lengths = {}
+    for lane in lanes[1:]:
+        points = np.asarray(lane["points"], dtype=float)
+        lane_lengths[lane["name"]] = np.linalg.norm(np.diff(points, axis=0), axis=1).sum()
+    for vehicle in vehicles:
+        crossing = vehicle.crossing_frame(vehicle.lane["points"], lane_lengths[vehicle.lane["name"]])
+        if 0 <= crossing < num_frames - 1:
+            direction = "inbound" if vehicle.downward else "outbound"
+            name = vehicle.lane["name"]
+            ground_truth["total"] += 1
+            ground_truth["per_lane"][name] = ground_truth["per_lane"].get(name, 0) + 1
+            ground_truth["per_direction"][direction] = ground_truth["per_direction"].get(direction, 0) + 1
+
+    # A static road with low-saturation texture
+    background = np.full((height, width, 3), 110, dtype=np.uint8)
+    background += rng.integers(0, 20, (height, width, 1), dtype=np.uint8)
+    sx, sy = width / MODEL_SIZE, height / MODEL_SIZE
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height), True)
+    for frame_index in range(num_frames):
+        frame = background.copy()
+        for vehicle in vehicles:
+            center = vehicle.position(frame_index, vehicle.lane["points"], lane_lengths[vehicle.lane["name"]])
+            if center is None:
+                continue
+            w, h = vehicle.size
+            l, t = int((center[0] - w / 2) * sx), int((center[1] - h / 2) * sy)
+            r, b = int((center[0] + w / 2) * sx), int((center[1] + h / 2) * sy)
+            # Colors are RGB; OpenCV writes BGR
+            cv2.rectangle(frame, (l, t), (r, b), vehicle.color[::-1], -1)
+        writer.write(frame)
+    writer.release()
+    return lanes, ground_truth, num_frames
+
+
+def main(args):
+    width, height = [int(v) for v in args.resolution.split("x")]
+    lanes, ground_truth, num_frames = generate_clip(
+        args.output, width, height, args.fps, args.duration, args.lanes, args.density, args.seed)
+    Path(args.output).with_suffix(".lanes.json").write_text(json.dumps(lanes))
+    Path(args.output).with_suffix(".truth.json").write_text(json.dumps(ground_truth))
+    print(f"Wrote {num_frames} frames to {args.output}: {ground_truth}")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Synthetic traffic clip generator')
+    parser.add_argument('--output', type=Path, default=Path('synthetic.mp4'), help='Path to the output clip')
+    parser.add_argument('--resolution', default='1280x720', help='WIDTHxHEIGHT of the clip')
+    parser.add_argument('--fps', type=float, default=15)
+    parser.add_argument('--duration', type=float, default=20., help='Length of the clip in seconds')
+    parser.add_argument('--lanes', type=int, default=4, help='Number of lanes')
+    parser.add_argument('--density', type=float, default=0.5, help='Vehicles per second per lane')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    exit(main(args))
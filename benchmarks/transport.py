@@ -0,0 +1,177 @@
+""" Memory per frame of passing frames from a decoder process to the detector.
+
+A producer process hands frames to a consumer process, which prepares the input
+of the detector from each frame as YOLOv7_Main does. Frames go either through a
+multiprocessing queue, which pickles each frame, or through a FrameRing, which
+passes only the index of a slot in shared memory. The producer fills its frames
+in place of decoding so that only the transport differs.
+
+Per frame, the bytes through the pipe are those of the first message pickled
+as the queue and the pipes of the ring pickle it, measured in the producer; the
+copies of a frame through the kernel are the bytes that both processes read and
+write by system calls while passing the frames, from /proc/self/io, in frames;
+the memory allocated by the consumer is traced with tracemalloc, as in
+benchmarks.allocations; peak RSS is of the consumer, which runs in a fresh
+process per case, and includes the pages of shared memory it touched.
+
+    python3 -m benchmarks.transport --resolution 640x640 1920x1080
+"""
+import argparse
+import multiprocessing as mp
+from multiprocessing.reduction import ForkingPickler
+import time
+import tracemalloc
+
+import numpy as np
+import torch
+
+from models.yolov7 import prepare_input
+from transport import FrameRing
+from benchmarks.memory import peak_rss_mb, reset_peak
+
+
+def message_bytes(message):
+    # As multiprocessing pickles a message for a pipe
+    return len(ForkingPickler.dumps(message))
+
+
+def io_bytes():
+    """ io_bytes returns the bytes that the process has read and written by system calls,
+    pipes included, or 0 where /proc/self/io is not available
+    """
+    try:
+        with open("/proc/self/io") as fp:
+            fields = dict(line.split(": ") for line in fp.read().splitlines())
+    except OSError:
+        return 0
+    return int(fields["rchar"]) + int(fields["wchar"])
+
+
+def produce_queue(queue, shape, frames, sizes):
+    start = io_bytes()
+    for i in range(frames):
+        # A decoder returns a new array per frame
+        frame = np.empty(shape, dtype=np.uint8)
+        frame.fill(i % 256)
+        if i == 0:
+            sizes.send(message_bytes((frame, i)))
+        queue.put((frame, i))
+    queue.put(None)
+    # The feeder thread of the queue writes to the pipe until it is flushed
+    queue.close()
+    queue.join_thread()
+    sizes.send(io_bytes() - start)
+
+
+def produce_ring(ring, shape, frames, sizes):
+    start = io_bytes()
+    for i in range(frames):
+        slot = ring.acquire()
+        ring.frames[slot].fill(i % 256)
+        if i == 0:
+            # The index of the slot goes to the consumer and comes back to be reused
+            sizes.send(message_bytes((slot, i)) + message_bytes(slot))
+        ring.publish(slot, i)
+    ring.finish()
+    sizes.send(io_bytes() - start)
+    ring.close()
+
+
+def consume(receive, release, size, frames, results):
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    out = torch.empty((1, 3, size[1], size[0]), dtype=torch.half, device=device)
+    allocated = []
+    start = None
+    io_start = io_bytes()
+    tracemalloc.start()
+    for i in range(frames + 1):
+        current = reset_peak()
+        received = receive()
+        if received is None:
+            break
+        frame, index = received
+        prepare_input([frame], size, out)
+        _, peak = tracemalloc.get_traced_memory()
+        frame = None
+        release(index)
+        if i == 0:
+            # The first frame waits for the producer to start
+            start = time.monotonic()
+        else:
+            allocated.append(peak - current)
+    elapsed = time.monotonic() - start
+    io = io_bytes() - io_start
+    tracemalloc.stop()
+    results.send({"fps": (frames - 1) / elapsed, "allocated": float(np.mean(allocated)), "peak_rss": peak_rss_mb(), "io_bytes": io})
+
+
+def consume_queue(queue, size, frames, results):
+    consume(queue.get, lambda index: None, size, frames, results)
+
+
+def consume_ring(ring, size, frames, results):
+    def receive():
+        published = ring.receive()
+        if published is None:
+            return None
+        slot, _ = published
+        return ring.frames[slot], slot
+    consume(receive, ring.release, size, frames, results)
+
+
+def run_case(transport, shape, args):
+    ctx = mp.get_context("spawn")
+    results_recv, results_send = ctx.Pipe(duplex=False)
+    sizes_recv, sizes_send = ctx.Pipe(duplex=False)
+    size = (640, 640)
+    if transport == "queue":
+        queue = ctx.Queue(maxsize=args.slots)
+        producer = ctx.Process(target=produce_queue, args=(queue, shape, args.frames, sizes_send))
+        consumer = ctx.Process(target=consume_queue, args=(queue, size, args.frames, results_send))
+        shared_bytes = 0
+    else:
+        ring = FrameRing(args.slots, shape)
+        producer = ctx.Process(target=produce_ring, args=(ring, shape, args.frames, sizes_send))
+        consumer = ctx.Process(target=consume_ring, args=(ring, size, args.frames, results_send))
+        shared_bytes = ring.shm.size
+    consumer.start()
+    producer.start()
+    pipe_bytes = sizes_recv.recv()
+    producer_io = sizes_recv.recv()
+    result = results_recv.recv()
+    producer.join()
+    consumer.join()
+    if transport == "ring":
+        ring.close()
+        ring.unlink()
+    result.update({
+        "transport": transport,
+        "resolution": f"{shape[1]}x{shape[0]}",
+        "pipe_bytes": pipe_bytes,
+        "shared_bytes": shared_bytes,
+        "copies": (producer_io + result["io_bytes"]) / (args.frames * int(np.prod(shape))),
+    })
+    return result
+
+
+def main(args):
+    print(f"{args.frames} frames with {args.slots} frames in flight")
+    print("| transport | resolution | FPS | pipe per frame | copies through the kernel per frame | consumer allocated per frame | shared memory | consumer peak RSS |")
+    print("|---|---|---|---|---|---|---|---|")
+    for resolution in args.resolution:
+        width, height = [int(v) for v in resolution.split("x")]
+        for transport in ["queue", "ring"]:
+            r = run_case(transport, (height, width, 3), args)
+            print(f"| {r['transport']} | {r['resolution']} | {r['fps']:.1f} | {r['pipe_bytes'] / 2**10:.2f} KiB | {r['copies']:.2f} | "
+                  f"{r['allocated'] / 2**20:.2f} MiB | {r['shared_bytes'] / 2**20:.1f} MiB | {r['peak_rss']:.0f} MiB |")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Memory per frame between a decoder process and the detector')
+    parser.add_argument('--resolution', nargs='+', default=['640x640', '1920x1080'], help='WIDTHxHEIGHT of the frames')
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--slots', type=int, default=8, help='Frames in flight: slots of the ring and the size of the queue')
+    args = parser.parse_args()
+
+    exit(main(args))
@@ -0,0 +1,74 @@
+""" Memory and time per frame of TrafficCounter.update with many tracked vehicles.
+
+    python3 -m benchmarks.vehicles --vehicles 1000 10000
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from app import TrafficCounter, load_class_names
+
+
+LANES = [
+    {"name": "count", "points": [[0, 320], [640, 320]]},
+    {"name": "lane1", "points": [[80, 0], [120, 320], [160, 640]]},
+    {"name": "lane2", "points": [[240, 0], [260, 320], [280, 640]]},
+    {"name": "lane3", "points": [[400, 0], [380, 320], [360, 640]]},
+    {"name": "lane4", "points": [[560, 0], [520, 320], [480, 640]]},
+]
+
+
+def make_trackers(n, frame, rng):
+    """ make_trackers returns n vehicles moving down the image as Sort.update would
+    """
+    trackers = np.empty((n, 6))
+    x = rng.uniform(0, 600, n)
+    y = (np.arange(n) * 7 + frame * 4) % 600
+    trackers[:, 0] = x
+    trackers[:, 1] = y
+    trackers[:, 2] = x + 40
+    trackers[:, 3] = y + 30
+    trackers[:, 4] = np.arange(1, n + 1)
+    trackers[:, 5] = 2
+    return trackers
+
+
+def run(n, frames, class_names):
+    rng = np.random.default_rng(0)
+    trackers = [make_trackers(n, frame, rng) for frame in range(frames)]
+
+    tracemalloc.start()
+    counter = TrafficCounter(LANES, class_names)
+    start = time.perf_counter()
+    for frame, tracker in enumerate(trackers):
+        counter.update(tracker, frame)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    counts = counter.report_results()
+    report_elapsed = time.perf_counter() - start
+    print(f"{n:>6} vehicles: {elapsed / frames * 1e3:8.2f} ms per frame, "
+          f"report {report_elapsed * 1e3:.2f} ms, "
+          f"table {counter.table.nbytes / 2**20:.2f} MiB ({counter.table.nbytes / n:.0f} B per vehicle), "
+          f"peak {peak / 2**20:.2f} MiB, counted {counts.total}")
+
+
+def main(args):
+    class_names = load_class_names(args.labels)
+    for n in args.vehicles:
+        run(n, args.frames, class_names)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Vehicle table benchmark')
+    parser.add_argument('--vehicles', type=int, nargs='+', default=[1000, 10000], help='Numbers of tracked vehicles')
+    parser.add_argument('--frames', type=int, default=50, help='Number of frames')
+    parser.add_argument('--labels', default='coco.names', help='Labels for detection')
+    args = parser.parse_args()
+
+    exit(main(args))
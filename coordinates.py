@@ -0,0 +1,67 @@
+import numpy as np
+
+
+class CoordinateSpace:
+    """ CoordinateSpace is the 2D space of an image of width by height, e.g. the native
+    frames of a camera or the input of the detector. Images of a scene in different spaces
+    are resizes of each other, so points are mapped between spaces by scaling each axis.
+    """
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+    def __eq__(self, other):
+        return isinstance(other, CoordinateSpace) and (self.width, self.height) == (other.width, other.height)
+
+    def __hash__(self):
+        return hash((self.width, self.height))
+
+    def __repr__(self):
+        return f"CoordinateSpace({self.width}, {self.height})"
+
+    def scale_to(self, other):
+        """ scale_to returns the scale of x and y from this space to the other
+        """
+        return np.array([other.width / self.width, other.height / self.height])
+
+    def map_points(self, points, other):
+        """ map_points maps points in shape (N, 2) into the other space
+        """
+        return np.asarray(points, dtype=float) * self.scale_to(other)
+
+    def map_boxes(self, boxes, other):
+        """ map_boxes maps boxes in shape (N, 4) of [x1, y1, x2, y2] into the other space
+        """
+        return np.asarray(boxes, dtype=float) * np.tile(self.scale_to(other), 2)
+
+    def map_warp(self, warp, other):
+        """ map_warp maps a 2x3 affine warp of images in this space to the other space
+        """
+        sx, sy = self.scale_to(other)
+        scale = np.diag([sx, sy])
+        inverse = np.diag([1 / sx, 1 / sy])
+        mapped = np.empty((2, 3))
+        mapped[:, :2] = scale @ warp[:, :2] @ inverse
+        mapped[:, 2] = scale @ warp[:, 2]
+        return mapped
+
+
+# Frames resized for the lanes tool. Lanes without a space were drawn in it.
+MODEL_SPACE = CoordinateSpace(640, 640)
+NORMALIZED_SPACE = CoordinateSpace(1, 1)
+
+
+def load_lanes_config(config):
+    """ load_lanes_config returns the lanes and their space of a lanes config, which is either
+    a list of lanes in the 640x640 space, or an object with the lanes and their space,
+        {"space": "normalized", "lanes": [...]}  points in [0, 1] of the width and height
+        {"size": [1920, 1080], "lanes": [...]}   points in pixels of an image of the size
+    """
+    if isinstance(config, list):
+        return config, MODEL_SPACE
+    if config.get("space") == "normalized":
+        return config["lanes"], NORMALIZED_SPACE
+    if "size" in config:
+        width, height = config["size"]
+        return config["lanes"], CoordinateSpace(width, height)
+    raise ValueError("lanes config needs either \"space\": \"normalized\" or \"size\"")
@@ -0,0 +1,208 @@
+""" Parallel decoding of recorded clips.
+
+A clip is split at keyframes into chunks by ffmpeg's segment muxer, which copies
+the packets without decoding so that every frame is in exactly one chunk. The
+chunks are decoded by a pool of processes, each into a block of shared memory,
+and the frames are delivered in order from the blocks without a copy.
+
+It needs Python 3.8 for shared memory, so it is for batch reprocessing on servers
+rather than for the image of the plugin on nodes.
+
+    with DecodePool(8) as pool:
+        with pool.reader("clip.mp4") as reader:
+            for frame in reader.stream():
+                ...
+"""
+import logging
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import cv2
+import ffmpeg
+import numpy as np
+from waggle.data.timestamp import get_timestamp
+
+# data is an RGB frame like the samples of waggle's Camera; timestamp is in nanoseconds
+Frame = namedtuple('Frame', ['data', 'timestamp'])
+# A chunk decoded into the shared memory block of the name
+DecodedChunk = namedtuple('DecodedChunk', ['name', 'count', 'shape', 'fps'])
+
+# Blocks whose frames a caller may still hold
+_retired = []
+
+
+def close_block(shm):
+    """ close_block closes a block of shared memory, or once the frames a caller holds of it are dropped
+    """
+    _retired.append(shm)
+    retired = []
+    for block in _retired:
+        try:
+            block.close()
+        except BufferError:
+            retired.append(block)
+    _retired[:] = retired
+
+
+def split_keyframes(path, directory, chunk_duration=2.):
+    """ split_keyframes copies the clip into chunks of at least chunk_duration seconds that start
+    at keyframes, and returns their paths
+    """
+    list_path = os.path.join(directory, 'chunks.csv')
+    (
+        ffmpeg
+        .input(str(path))
+        .output(os.path.join(directory, 'chunk%05d.mp4'), codec='copy', an=None, f='segment',
+            segment_time=chunk_duration, segment_list=list_path, segment_list_type='csv',
+            segment_format='mp4', reset_timestamps=1)
+        .global_args('-loglevel', 'error')
+        .overwrite_output()
+        .run())
+    chunks = []
+    with open(list_path) as fp:
+        for line in fp.read().splitlines():
+            filename, _, _ = line.split(",")
+            chunks.append(os.path.join(directory, filename))
+    return chunks
+
+
+def init_decoder():
+    # The pool decodes chunks in parallel; threads within a decoder would only compete for the cores
+    cv2.setNumThreads(1)
+
+
+def decode_chunk(path):
+    """ decode_chunk decodes a chunk into a new shared memory block of RGB frames. The block
+    is left for the caller to unlink.
+    """
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise RuntimeError(f"unable to open video capture for {path}")
+    height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    # The frame count of the container; grown below if it is short
+    capacity = max(1, int(capture.get(cv2.CAP_PROP_FRAME_COUNT)))
+    shm = SharedMemory(create=True, size=capacity * height * width * 3)
+    frames = np.ndarray((capacity, height, width, 3), dtype=np.uint8, buffer=shm.buf)
+    frame = None
+    count = 0
+    try:
+        while capture.grab():
+            if count == capacity:
+                capacity *= 2
+                grown = SharedMemory(create=True, size=capacity * height * width * 3)
+                grown_frames = np.ndarray((capacity, height, width, 3), dtype=np.uint8, buffer=grown.buf)
+                grown_frames[:count] = frames[:count]
+                # Views of a block must be dropped before it is closed
+                frames = frame = None
+                shm.close()
+                shm.unlink()
+                shm, frames = grown, grown_frames
+                grown_frames = None
+            frame = frames[count]
+            # Decoded and converted in place in the block
+            ok, _ = capture.retrieve(frame)
+            if not ok:
+                break
+            cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
+            count += 1
+    except BaseException:
+        frames = frame = None
+        shm.close()
+        shm.unlink()
+        raise
+    finally:
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        capture.release()
+    frames = frame = None
+    shm.close()
+    return DecodedChunk(shm.name, count, (height, width), fps)
+
+
+class DecodePool:
+    """ DecodePool is a pool of decoder processes shared by the readers of many clips
+    """
+    def __init__(self, workers=os.cpu_count()):
+        self.workers = workers
+        # Fresh processes, as the caller may hold CUDA, which does not survive fork
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn"),
+            initializer=init_decoder)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def reader(self, path, chunk_duration=2.):
+        return ParallelReader(path, self, chunk_duration)
+
+    def shutdown(self):
+        # Readers cancel the chunks they have pending when they exit
+        self.executor.shutdown(wait=True)
+
+
+class ParallelReader:
+    """ ParallelReader reads the frames of a clip in order like waggle's Camera, decoding
+    chunks of the clip in the processes of a DecodePool. At most one chunk per decoder plus
+    the chunk being read are held in memory. A frame is a view of shared memory that is valid
+    until the frames of the next chunk are read; copy it to keep it longer.
+    """
+    def __init__(self, path, pool, chunk_duration=2.):
+        self.path = str(path)
+        self.pool = pool
+        self.chunk_duration = chunk_duration
+        self.directory = None
+        self.pending = deque()
+
+    def __enter__(self):
+        # Chunks go on tmpfs if there is one; they are only read once
+        self.directory = tempfile.mkdtemp(prefix="chunks-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+        self.chunks = split_keyframes(self.path, self.directory, self.chunk_duration)
+        logging.info(f"Split {self.path} into {len(self.chunks)} chunks for {self.pool.workers} decoders")
+        # Frames are timestamped from the start of the read as by waggle's Camera, but at the
+        # frame rate of the clip rather than the rate of decoding
+        self.timestamp = get_timestamp()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        while len(self.pending) > 0:
+            future = self.pending.popleft()
+            if future.cancel():
+                continue
+            try:
+                chunk = future.result()
+            except Exception:
+                continue
+            shm = SharedMemory(name=chunk.name)
+            shm.close()
+            shm.unlink()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def stream(self):
+        # One chunk per decoder is decoded ahead of the chunk being read
+        paths = iter(self.chunks)
+        for path in paths:
+            self.pending.append(self.pool.executor.submit(decode_chunk, path))
+            if len(self.pending) == self.pool.workers:
+                break
+        index = 0
+        for _ in self.chunks:
+            chunk = self.pending.popleft().result()
+            path = next(paths, None)
+            if path is not None:
+                self.pending.append(self.pool.executor.submit(decode_chunk, path))
+            shm = SharedMemory(name=chunk.name)
+            # The mapping stays valid until it is closed; unlinked now so that the block is never left behind
+            shm.unlink()
+            frames = np.ndarray((chunk.count, *chunk.shape, 3), dtype=np.uint8, buffer=shm.buf)
+            for i in range(chunk.count):
+                yield Frame(frames[i], self.timestamp + int(index / chunk.fps * 1e9))
+                index += 1
+            del frames
+            close_block(shm)
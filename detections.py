@@ -0,0 +1,68 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+
+# Columns of a detection as returned by NMS
+COLUMNS = ["x1", "y1", "x2", "y2", "score", "class"]
+
+
+class DetectionWriter:
+    """ DetectionWriter saves the detections of every frame of a clip into a directory,
+        detections.npy  all detections as float32 in shape (N, 6), see COLUMNS
+        offsets.npy     int64 in shape (frames + 1,); detections of frame i are rows offsets[i]:offsets[i+1]
+        timestamps.npy  int64 timestamp of each frame
+        meta.json       information of the clip, e.g. its timestamp, and
+                        "space", [width, height] of the boxes if not in the 640x640 space
+    The arrays are plain .npy files so that DetectionReader can memory-map them.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.meta = {}
+        self.chunks = []
+        self.offsets = [0]
+        self.timestamps = []
+
+    def write(self, detections, timestamp):
+        detections = np.asarray(detections, dtype=np.float32).reshape(-1, len(COLUMNS))
+        self.chunks.append(detections)
+        self.offsets.append(self.offsets[-1] + len(detections))
+        self.timestamps.append(timestamp)
+
+    def close(self, **meta):
+        if len(self.chunks) > 0:
+            detections = np.concatenate(self.chunks)
+        else:
+            detections = np.empty((0, len(COLUMNS)), dtype=np.float32)
+        np.save(self.path / "detections.npy", detections)
+        np.save(self.path / "offsets.npy", np.array(self.offsets, dtype=np.int64))
+        np.save(self.path / "timestamps.npy", np.array(self.timestamps, dtype=np.int64))
+        meta.update(self.meta)
+        meta["columns"] = COLUMNS
+        (self.path / "meta.json").write_text(json.dumps(meta))
+
+
+class DetectionReader:
+    """ DetectionReader memory-maps the detections saved by DetectionWriter.
+    Frames are returned as views into the mapped file without copies.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.detections = np.load(self.path / "detections.npy", mmap_mode="r")
+        self.offsets = np.load(self.path / "offsets.npy", mmap_mode="r")
+        self.timestamps = np.load(self.path / "timestamps.npy", mmap_mode="r")
+        self.meta = json.loads((self.path / "meta.json").read_text())
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, i):
+        return self.detections[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        """ yields the timestamp and the detections of each frame
+        """
+        for i in range(len(self)):
+            yield int(self.timestamps[i]), self[i]
@@ -0,0 +1,173 @@
+import logging
+import queue
+import threading
+from collections import deque
+
+import cv2
+import ffmpeg
+import numpy as np
+
+
+class OpenCVWriter:
+    """ OpenCVWriter writes RGB frames with cv2.VideoWriter in MPEG-4 Part 2 on the calling thread
+    """
+    def __init__(self, path, fps, size=(640, 640)):
+        self.writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'mp4v'), fps, size, True)
+
+    def write(self, frame):
+        self.writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+
+    def release(self):
+        self.writer.release()
+
+
+class FFmpegWriter:
+    """ FFmpegWriter encodes RGB frames in H.264 by an ffmpeg process fed from a background thread.
+    write only puts the frame in a bounded queue, so the caller never waits for the encoder;
+    if the queue is full the frame is dropped. The caller must not modify a frame after writing it.
+    """
+    def __init__(self, path, fps, size=(640, 640), crf=28, preset="veryfast", queue_size=32):
+        width, height = size
+        self.process = (
+            ffmpeg
+            .input('pipe:', format='rawvideo', pix_fmt='rgb24', s=f'{width}x{height}', framerate=fps)
+            .output(str(path), vcodec='libx264', crf=crf, preset=preset, pix_fmt='yuv420p', movflags='+faststart')
+            .global_args('-loglevel', 'error')
+            .overwrite_output()
+            .run_async(pipe_stdin=True))
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.written = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, frame):
+        try:
+            self.queue.put_nowait(frame)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                return
+            try:
+                self.process.stdin.write(np.ascontiguousarray(frame).data)
+            except (BrokenPipeError, ValueError):
+                logging.error("ffmpeg encoder exited; the rest of the frames are dropped")
+                self._drain()
+                return
+            self.written += 1
+
+    def _drain(self):
+        while self.queue.get() is not None:
+            self.dropped += 1
+
+    def release(self):
+        """ release encodes the frames left in the queue and waits for ffmpeg to finish the file
+        """
+        self.queue.put(None)
+        self.thread.join()
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+        if self.dropped > 0:
+            logging.warning(f"Encoder dropped {self.dropped} of {self.written + self.dropped} frames")
+
+
+def open_writer(path, fps, size=(640, 640), encoder="ffmpeg", crf=28, preset="veryfast"):
+    """ open_writer returns a writer of RGB frames by the encoder, either ffmpeg or opencv
+    """
+    if encoder == "ffmpeg":
+        return FFmpegWriter(path, fps, size, crf=crf, preset=preset)
+    elif encoder == "opencv":
+        return OpenCVWriter(path, fps, size)
+    raise ValueError(f"unknown encoder {encoder}")
+
+
+class OutputPolicy:
+    """ OutputPolicy decides which frames go to the writer. This one writes every frame.
+    The caller passes a frame to write only if wants returns True for it, and tells write
+    whether an event, e.g. a vehicle crossing the count line, happened in the frame.
+    A frame is passed unrendered, as an object whose render returns the RGB frame and whose
+    keep makes it safe to hold past the next frame; it is rendered only when it is written.
+    """
+    def __init__(self, writer):
+        self.writer = writer
+        self.written = 0
+
+    def wants(self, frame_index):
+        return True
+
+    def write(self, frame, event=False):
+        self._write(frame)
+
+    def _write(self, frame):
+        self.writer.write(frame.render())
+        self.written += 1
+
+    def release(self):
+        self.writer.release()
+
+
+class EveryNthPolicy(OutputPolicy):
+    """ EveryNthPolicy writes every nth frame
+    """
+    def __init__(self, writer, n):
+        super().__init__(writer)
+        self.n = max(1, n)
+
+    def wants(self, frame_index):
+        return frame_index % self.n == 0
+
+
+class EventPolicy(OutputPolicy):
+    """ EventPolicy writes frames around events: pre_roll frames before an event are kept
+    unrendered in a ring buffer and rendered when the event happens, followed by post_roll
+    frames, so that only the frames around events are rendered. If max_frames is positive,
+    it stops writing after max_frames for a highlight reel of a fixed size.
+    """
+    def __init__(self, writer, pre_roll=15, post_roll=15, max_frames=0):
+        super().__init__(writer)
+        self.pre_roll = deque(maxlen=max(0, pre_roll))
+        self.post_roll = post_roll
+        self.remaining = 0
+        self.max_frames = max_frames
+
+    def full(self):
+        return self.max_frames > 0 and self.written >= self.max_frames
+
+    def wants(self, frame_index):
+        return not self.full()
+
+    def write(self, frame, event=False):
+        if event:
+            while len(self.pre_roll) > 0 and not self.full():
+                self._write(self.pre_roll.popleft())
+            self.pre_roll.clear()
+            self.remaining = self.post_roll + 1
+        if self.remaining > 0:
+            if not self.full():
+                self._write(frame)
+            self.remaining -= 1
+        elif self.pre_roll.maxlen > 0:
+            self.pre_roll.append(frame.keep())
+
+
+def open_output(path, fps, size=(640, 640), encoder="ffmpeg", crf=28, preset="veryfast",
+        policy="all", every=10, pre_roll=15, post_roll=15, max_frames=300):
+    """ open_output returns the policy of writing frames to a writer opened by open_writer
+    """
+    if policy == "all":
+        return OutputPolicy(open_writer(path, fps, size, encoder, crf, preset))
+    elif policy == "every":
+        # The video plays at the original speed
+        return EveryNthPolicy(open_writer(path, fps / max(1, every), size, encoder, crf, preset), every)
+    elif policy == "events":
+        return EventPolicy(open_writer(path, fps, size, encoder, crf, preset), pre_roll, post_roll)
+    elif policy == "highlights":
+        return EventPolicy(open_writer(path, fps, size, encoder, crf, preset), pre_roll, post_roll, max_frames)
+    raise ValueError(f"unknown output policy {policy}")
@@ -0,0 +1,83 @@
+import numpy as np
+
+
+class KalmanBoxFilter():
+    """ KalmanBoxFilter is a Kalman filter specialized for the box model of SORT.
+    The state is [x, y, s, r, vx, vy, vs] and the measurement is [x, y, s, r].
+    Each of x, y and s is coupled only with its own velocity and r has no velocity,
+    so with diagonal Q and R the covariance stays block diagonal. The filter keeps
+    the 2x2 blocks as vectors and updates them in closed form, which avoids the
+    generic matrix products, the 4x4 inverse and temporary arrays of a general filter.
+
+    dt=0 gives the identity transition used by KalmanBoxTracker and dt=1 gives
+    the constant velocity model of the original SORT.
+    """
+    def __init__(self, R_diag, Q_pos, Q_vel, P_pos=1., P_vel=0.96, dt=0.):
+        self.dt = dt
+        self.x = np.zeros((7, 1))
+        self._pos = self.x[:4, 0]
+        self._vel = self.x[4:, 0]
+
+        # Covariance blocks of (position, velocity) pairs for x, y, s and r.
+        # r has no velocity, so its velocity terms are kept zero.
+        self._p_pp = np.full(4, P_pos, dtype=float)
+        self._p_pv = np.zeros(4)
+        self._p_vv = np.array([P_vel, P_vel, P_vel, 0.])
+        self._q_pos = np.array([Q_pos, Q_pos, Q_pos, Q_vel])
+        self._q_vel = np.array([Q_vel, Q_vel, Q_vel, 0.])
+        self._r = float(R_diag)
+
+        # Buffers reused by every step
+        self._y = np.empty(4)
+        self._s = np.empty(4)
+        self._k_pos = np.empty(4)
+        self._k_vel = np.empty(4)
+        self._tmp = np.empty(4)
+
+    @property
+    def P(self):
+        """ P returns the full 7x7 covariance matrix
+        """
+        P = np.zeros((7, 7))
+        idx = np.arange(4)
+        P[idx, idx] = self._p_pp
+        P[idx[:3], idx[:3] + 4] = self._p_pv[:3]
+        P[idx[:3] + 4, idx[:3]] = self._p_pv[:3]
+        P[idx[:3] + 4, idx[:3] + 4] = self._p_vv[:3]
+        return P
+
+    def predict(self):
+        dt = self.dt
+        tmp = self._tmp
+        if dt:
+            np.multiply(self._vel, dt, out=tmp[:3])
+            self._pos[:3] += tmp[:3]
+            # P_pp += 2dt P_pv + dt^2 P_vv, then P_pv += dt P_vv
+            np.multiply(self._p_pv, 2 * dt, out=tmp)
+            self._p_pp += tmp
+            np.multiply(self._p_vv, dt * dt, out=tmp)
+            self._p_pp += tmp
+            np.multiply(self._p_vv, dt, out=tmp)
+            self._p_pv += tmp
+        self._p_pp += self._q_pos
+        self._p_vv += self._q_vel
+
+    def update(self, z):
+        y, s, k_pos, k_vel, tmp = self._y, self._s, self._k_pos, self._k_vel, self._tmp
+        np.subtract(z.ravel(), self._pos, out=y)
+        np.add(self._p_pp, self._r, out=s)
+        np.divide(self._p_pp, s, out=k_pos)
+        np.divide(self._p_pv, s, out=k_vel)
+
+        np.multiply(k_pos, y, out=tmp)
+        self._pos += tmp
+        np.multiply(k_vel, y, out=tmp)
+        self._vel += tmp[:3]
+
+        # The velocity block must be updated before P_pv changes
+        np.multiply(k_vel, self._p_pv, out=tmp)
+        self._p_vv -= tmp
+        np.multiply(k_pos, self._p_pv, out=tmp)
+        self._p_pv -= tmp
+        np.multiply(k_pos, self._p_pp, out=tmp)
+        self._p_pp -= tmp
@@ -0,0 +1,72 @@
+import time
+
+import cv2
+import numpy as np
+
+
+class GlobalMotionEstimator():
+    """ GlobalMotionEstimator estimates the motion of the camera between two consecutive frames.
+    Corners are tracked with sparse optical flow on a downscaled grayscale frame,
+    ignoring the areas covered by vehicles, and a similarity transform is fitted to them.
+    The result is a 2x3 affine warp that maps points of the previous frame to the current frame.
+    """
+    def __init__(self, scale=0.25, max_corners=200, min_matches=10, ransac_thres=1.0):
+        self.scale = scale
+        self.max_corners = max_corners
+        self.min_matches = min_matches
+        self.ransac_thres = ransac_thres
+        self.prev_gray = None
+        self.prev_points = None
+
+        # Per-frame cost of the estimation in seconds
+        self.frames = 0
+        self.elapsed_last = 0.
+        self.elapsed_total = 0.
+        self.elapsed_max = 0.
+
+    def estimate(self, frame, boxes=None):
+        """ estimate returns the warp from the previous frame to the given frame.
+        The frame and the boxes in [x1,y1,x2,y2] should share the same coordination space.
+        An identity warp is returned when the motion cannot be estimated.
+        """
+        start = time.monotonic()
+        warp = np.eye(2, 3, dtype=np.float64)
+
+        small = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY)
+
+        if self.prev_points is not None and len(self.prev_points) >= self.min_matches:
+            points, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, self.prev_points, None)
+            good = status.ravel() == 1
+            if good.sum() >= self.min_matches:
+                m, _ = cv2.estimateAffinePartial2D(
+                    self.prev_points[good], points[good],
+                    method=cv2.RANSAC,
+                    ransacReprojThreshold=self.ransac_thres)
+                if m is not None:
+                    warp = m
+                    # Translation was estimated in the downscaled space
+                    warp[:, 2] /= self.scale
+
+        # Vehicles move on their own; corners on them do not represent the camera motion
+        mask = np.full(gray.shape, 255, dtype=np.uint8)
+        if boxes is not None:
+            for box in np.asarray(boxes)[:, :4] * self.scale:
+                l, t, r, b = np.clip(box, 0, None).astype(int)
+                mask[t:b+1, l:r+1] = 0
+        self.prev_gray = gray
+        self.prev_points = cv2.goodFeaturesToTrack(
+            gray, self.max_corners, 0.01, 8, mask=mask)
+
+        self.elapsed_last = time.monotonic() - start
+        self.elapsed_total += self.elapsed_last
+        self.elapsed_max = max(self.elapsed_max, self.elapsed_last)
+        self.frames += 1
+        return warp
+
+    def report(self):
+        """ report returns the mean and max cost of the estimation per frame in milliseconds
+        """
+        if self.frames == 0:
+            return 0., 0.
+        return self.elapsed_total / self.frames * 1e3, self.elapsed_max * 1e3
@@ -14,9 +14,12 @@
 """
 from __future__ import print_function
 
+from collections import namedtuple
+
 import numpy as np
 
-from filterpy.kalman import KalmanFilter
+from .kalman import KalmanBoxFilter
+from .trajectory import Trajectory
 
 np.random.seed(0)
 
@@ -79,15 +82,22 @@ def convert_x_to_bbox(x,score=None):
     return np.array([x[0]-w/2.,x[1]-h/2.,x[0]+w/2.,x[1]+h/2.,score]).reshape((1,5))
 
 
+# Lifecycle event of a track. kind is one of "born", "confirmed", "lost" and "terminated".
+# track_id matches the ID column returned by Sort.update and the remaining fields
+# are the state of the track when the event occurred.
+TrackEvent = namedtuple('TrackEvent', ['kind', 'track_id', 'frame', 'bbox', 'class_num', 'hits', 'age'])
+
+
 class KalmanBoxTracker(object):
   """
   This class represents the internal state of individual tracked objects observed as bbox.
   """
   count = 0
 #   def __init__(self, bbox, R_diag=0.15, Q_pos=0.106123, Q_vel=0.016327):
-  def __init__(self, bbox, R_diag=0.15, Q_pos=0.0106123, Q_vel=0.016327):
+  def __init__(self, bbox, R_diag=0.15, Q_pos=0.0106123, Q_vel=0.016327, history_size=32):
     """
     Initialises a tracker using initial bounding box.
+    history_size bounds the predicted boxes kept while the tracker coasts without detections.
     """
     #define constant velocity model
     # self.kf = KalmanFilter(dim_x=7, dim_z=4)
@@ -100,38 +110,49 @@ class KalmanBoxTracker(object):
     # self.kf.Q[-1,-1] *= 0.01
     # self.kf.Q[4:,4:] *= 0.01
 
-    self.kf = KalmanFilter(dim_x=7, dim_z=4)
-    self.kf.F = np.eye(7, dtype=float)
-    self.kf.H = np.eye(7, dtype=float)[:4]
+    # The filter is equivalent to filterpy's KalmanFilter(dim_x=7, dim_z=4) with
+    # F = eye(7), H = eye(7)[:4], R = R_diag * I, Q = diag(Q_pos x3, Q_vel x4)
+    # and P = diag(1.0 x4, 0.96 x3), specialized for the fixed model
     # This is all derived from MM optimization work
     # FIXME: pretty sure these values are not optimal
     # which is in pixel space, here we track relative
-    np.fill_diagonal(self.kf.R, R_diag)
-    np.fill_diagonal(self.kf.Q[:3, :3], Q_pos)
-    np.fill_diagonal(self.kf.Q[3:, 3:], Q_vel)
-    np.fill_diagonal(self.kf.P[:4, :4], 1.0)
-    np.fill_diagonal(self.kf.P[4:, 4:], 0.96)
+    self.kf = KalmanBoxFilter(R_diag, Q_pos, Q_vel, P_pos=1.0, P_vel=0.96)
 
+    # Votes of the detected classes; the majority is kept as class_num
+    self.class_votes = {}
     self.class_num = bbox[-1]
+    self.vote_class(bbox[-1])
     self.kf.x[:4] = convert_bbox_to_z(bbox)
     self.time_since_update = 0
     self.id = KalmanBoxTracker.count
     KalmanBoxTracker.count += 1
-    self.history = []
+    self.history = Trajectory(history_size, dim=4)
     self.hits = 0
     self.hit_streak = 0
     self.age = 0
+    self.confirmed = False
 
   def update(self,bbox):
     """
     Updates the state vector with observed bbox.
     """
     self.time_since_update = 0
-    self.history = []
+    self.history.clear()
     self.hits += 1
     self.hit_streak += 1
+    self.vote_class(bbox[-1])
     self.kf.update(convert_bbox_to_z(bbox))
 
+  def vote_class(self, class_num):
+    """
+    Counts a vote for the detected class and updates the majority class.
+    The earliest class wins ties.
+    """
+    votes = self.class_votes.get(class_num, 0) + 1
+    self.class_votes[class_num] = votes
+    if votes > self.class_votes[self.class_num]:
+      self.class_num = class_num
+
   def predict(self):
     """
     Advances the state vector and returns the predicted bounding box estimate.
@@ -143,8 +164,25 @@ class KalmanBoxTracker(object):
     if(self.time_since_update>0):
       self.hit_streak = 0
     self.time_since_update += 1
-    self.history.append(convert_x_to_bbox(self.kf.x))
-    return self.history[-1]
+    box = convert_x_to_bbox(self.kf.x)
+    self.history.append(box[0], self.age)
+    return box
+
+  def apply_warp(self, warp):
+    """
+    Moves the predicted state by a 2x3 affine warp of the image (e.g. camera motion)
+    and returns the compensated bounding box estimate.
+    """
+    a = warp[:, :2]
+    self.kf.x[:2] = np.dot(a, self.kf.x[:2]) + warp[:, 2:]
+    self.kf.x[4:6] = np.dot(a, self.kf.x[4:6])
+    # area scales with the determinant of the linear part
+    scale = abs(np.linalg.det(a))
+    self.kf.x[2] *= scale
+    self.kf.x[6] *= scale
+    box = convert_x_to_bbox(self.kf.x)
+    self.history[-1] = box[0]
+    return box
 
   def get_state(self):
     """
@@ -207,28 +245,49 @@ class Sort(object):
     self.iou_threshold = iou_threshold
     self.trackers = []
     self.frame_count = 0
+    self._events = []
+
+  def _emit(self, kind, trk):
+    self._events.append(TrackEvent(kind, trk.id+1, self.frame_count, trk.get_state()[0],
+      trk.class_num, trk.hits, trk.age))
+
+  def events(self):
+    """
+    Yields the lifecycle events of the tracks that occurred in the last call of update.
+      born - a tracker is created for an unmatched detection
+      confirmed - the track is returned by update for the first time
+      lost - the track missed its first detection since the last match
+      terminated - the tracker is removed; the event carries its final state
+    The events are kept only until the next update, so it is safe not to consume them.
+    """
+    yield from self._events
 
-  def update(self, dets=np.empty((0, 5))):
+  def update(self, dets=np.empty((0, 5)), warp=None):
     """
     Params:
       dets - a numpy array of detections in the format [[x1,y1,x2,y2,score],[x1,y1,x2,y2,score],...]
+      warp - an optional 2x3 affine warp of the camera motion since the last frame.
+        It is applied to the predicted boxes before the association.
     Requires: this method must be called once for each frame even with empty detections (use np.empty((0, 5)) for frames without detections).
     Returns the a similar array, where the last column is the object ID.
     NOTE: The number of objects returned may differ from the number of detections provided.
     """
     self.frame_count += 1
+    self._events = []
     # get predicted locations from existing trackers.
     trks = np.zeros((len(self.trackers), 5))
     to_del = []
     ret = []
     for t, trk in enumerate(trks):
       pos = self.trackers[t].predict()[0]
+      if warp is not None:
+        pos = self.trackers[t].apply_warp(warp)[0]
       trk[:] = [pos[0], pos[1], pos[2], pos[3], 0]
       if np.any(np.isnan(pos)):
         to_del.append(t)
     trks = np.ma.compress_rows(np.ma.masked_invalid(trks))
     for t in reversed(to_del):
-      self.trackers.pop(t)
+      self._emit("terminated", self.trackers.pop(t))
     matched, unmatched_dets, unmatched_trks = associate_detections_to_trackers(dets,trks, self.iou_threshold)
 
     # update matched trackers with assigned detections
@@ -239,15 +298,21 @@ class Sort(object):
     for i in unmatched_dets:
         trk = KalmanBoxTracker(dets[i,:])
         self.trackers.append(trk)
+        self._emit("born", trk)
     i = len(self.trackers)
     for trk in reversed(self.trackers):
         d = trk.get_state()[0]
         if (trk.time_since_update < 1) and (trk.hit_streak >= self.min_hits or self.frame_count <= self.min_hits):
-          ret.append(np.concatenate((d,[trk.id+1],[trk.class_num])).reshape(1,-1)) # +1 as MOT benchmark requires positive
+          ret.append(np.concatenate((d,[trk.id+1],[trk.class_num])).reshape(1,-1)) # +1 as MOT benchmark requires positive; class_num is the majority vote
+          if not trk.confirmed:
+            trk.confirmed = True
+            self._emit("confirmed", trk)
+        elif trk.time_since_update == 1:
+          self._emit("lost", trk)
         i -= 1
         # remove dead tracklet
         if(trk.time_since_update > self.max_age):
-          self.trackers.pop(i)
+          self._emit("terminated", self.trackers.pop(i))
     if(len(ret)>0):
         return np.concatenate(ret)
     return np.empty((0,5))
@@ -0,0 +1,93 @@
+import numpy as np
+
+
+class Trajectories():
+    """ Trajectories keeps the most recent points of many tracks and their timestamps,
+    one fixed-size ring buffer per row, in arrays shared by all rows. The memory of
+    a trajectory does not grow however long the track lives; the oldest points are
+    overwritten.
+    """
+    def __init__(self, rows, capacity=32, dim=2):
+        self.capacity = capacity
+        self.points = np.zeros((rows, capacity, dim))
+        self.timestamps = np.zeros((rows, capacity))
+        # heads are where the next points are written
+        self.heads = np.zeros(rows, dtype=np.int32)
+        self.sizes = np.zeros(rows, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    @property
+    def nbytes(self):
+        return self.points.nbytes + self.timestamps.nbytes + self.heads.nbytes + self.sizes.nbytes
+
+    def resize(self, rows):
+        """ resize grows or shrinks the number of rows, keeping the trajectories of the rows kept
+        """
+        kept = min(rows, len(self))
+        for name in ["points", "timestamps", "heads", "sizes"]:
+            column = getattr(self, name)
+            resized = np.zeros((rows,) + column.shape[1:], dtype=column.dtype)
+            resized[:kept] = column[:kept]
+            setattr(self, name, resized)
+
+    def index(self, row, i):
+        """ index returns the position in the buffer of the i-th point of the row, oldest first.
+        Negative indices count from the newest.
+        """
+        size = self.sizes[row]
+        if i < -size or i >= size:
+            raise IndexError("trajectory index out of range")
+        if i < 0:
+            i += size
+        return (self.heads[row] - size + i) % self.capacity
+
+    def append(self, rows, points, timestamps):
+        """ append adds a point to each of the rows, which may be one row or an array of rows
+        """
+        heads = self.heads[rows]
+        self.points[rows, heads] = points
+        self.timestamps[rows, heads] = timestamps
+        self.heads[rows] = (heads + 1) % self.capacity
+        self.sizes[rows] = np.minimum(self.sizes[rows] + 1, self.capacity)
+
+    def clear(self, rows):
+        self.heads[rows] = 0
+        self.sizes[rows] = 0
+
+    def ordered(self, row):
+        """ ordered returns copies of the points and timestamps of the row, oldest first
+        """
+        size = self.sizes[row]
+        idx = (np.arange(size) + self.heads[row] - size) % self.capacity
+        return self.points[row, idx], self.timestamps[row, idx]
+
+
+class Trajectory():
+    """ Trajectory is the ring buffer of a single track, e.g. the predicted boxes of a tracker
+    """
+    def __init__(self, capacity=32, dim=2):
+        self.trajectories = Trajectories(1, capacity, dim)
+
+    def __len__(self):
+        return int(self.trajectories.sizes[0])
+
+    def __getitem__(self, i):
+        """ Returns the i-th point, oldest first. Negative indices count from the newest.
+        """
+        return self.trajectories.points[0, self.trajectories.index(0, i)]
+
+    def __setitem__(self, i, point):
+        self.trajectories.points[0, self.trajectories.index(0, i)] = point
+
+    def append(self, point, timestamp):
+        self.trajectories.append(0, point, timestamp)
+
+    def clear(self):
+        self.trajectories.clear(0)
+
+    def ordered(self):
+        """ ordered returns copies of the points and timestamps, oldest first
+        """
+        return self.trajectories.ordered(0)
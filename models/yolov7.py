@@ -4,19 +4,47 @@ import cv2
 
 from .common import Conv
 from .experimental import Ensemble
-from .utils.general import non_max_suppression
+from .utils.general import non_max_suppression, check_img_size, scale_coords
+
+
+def prepare_input(frames, size, out):
+    """ prepare_input letterboxes the RGB frames into out, a half tensor of (batch, 3, height, width)
+    scaled to [0, 1]: each frame is resized to fit size keeping its aspect ratio and padded
+    to size. Frames already at size are not resized. Frames are moved to the device as uint8 and
+    converted there, so no float copy of a frame is made on the host.
+    It returns the tensor, the (gain, padding) of each frame for scale_coords, and each frame
+    as resized on the host, without the padding, for reuse by visualization.
+    """
+    width, height = size
+    ratio_pads = []
+    resized = []
+    for i, frame in enumerate(frames):
+        h0, w0 = frame.shape[:2]
+        gain = min(width / w0, height / h0)
+        w1, h1 = round(w0 * gain), round(h0 * gain)
+        if (w1, h1) != (w0, h0):
+            frame = cv2.resize(frame, (w1, h1), interpolation=cv2.INTER_LINEAR)
+        left, top = (width - w1) // 2, (height - h1) // 2
+        if (w1, h1) != (width, height):
+            # Gray padding as in training
+            out[i].fill_(114)
+        image = torch.from_numpy(frame).to(out.device)
+        out[i, :, top:top + h1, left:left + w1].copy_(image.permute(2, 0, 1))
+        ratio_pads.append(((gain, gain), (left, top)))
+        resized.append(frame)
+    return out.div_(255.0), ratio_pads, resized
 
 
 class YOLOv7_Main():
-    def __init__(self, weightfile, detection_threshold, iou_threshold):
+    def __init__(self, weightfile, detection_threshold, iou_threshold, device=None, img_size=(640, 640)):
         self.det_thr = detection_threshold
         self.iou_thres = iou_threshold
 
-        self.use_cuda = torch.cuda.is_available()
-        if self.use_cuda:
-            self.device = 'cuda'
-        else:
-            self.device = 'cpu'
+        # device selects e.g. a GPU by 'cuda:1'; the first GPU or CPU is used if not given
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = device
+        self.use_cuda = self.device.startswith('cuda')
 
         self.model = Ensemble()
         ckpt = torch.load(weightfile, map_location=self.device)
@@ -34,19 +62,45 @@ class YOLOv7_Main():
         self.model = self.model.half()
         self.model.eval()
 
-    def prepare_input(self, frame, size=(640, 640)):
-        sized = cv2.resize(frame, size)
-        image = sized / 255.0
-        image = image.transpose((2, 0, 1))
-        image = torch.from_numpy(image).to(self.device).half()
-        image = image.unsqueeze(0)
+        # The input is img_size of (width, height), rounded up to multiples of the largest stride,
+        # e.g. 640x384 for 16:9 frames wastes less compute on padding than 640x640
+        stride = int(max(m.stride.max() for m in self.model if getattr(m, 'stride', None) is not None))
+        self.size = (check_img_size(img_size[0], stride), check_img_size(img_size[1], stride))
+        self.input = None
+        self.frame_shapes = []
+        self.ratio_pads = []
+        self.resized = []
+
+    def prepare_input(self, frames):
+        """ prepare_input converts the frames into the input tensor of the model.
+        The tensor is reused over calls as long as the batch size does not change.
+        """
+        shape = (len(frames), 3, self.size[1], self.size[0])
+        if self.input is None or tuple(self.input.shape) != shape:
+            self.input = torch.empty(shape, dtype=torch.half, device=self.device)
+        image, self.ratio_pads, self.resized = prepare_input(frames, self.size, self.input)
+        self.frame_shapes = [frame.shape[:2] for frame in frames]
         return image
 
-    def run(self, frame):
-        image = self.prepare_input(frame)
+    def infer(self, frame):
+        return self.infer_batch([frame])
+
+    def infer_batch(self, frames):
+        """ infer_batch runs one forward pass over the frames, e.g. of multiple cameras.
+        suppress of the prediction returns the detections of each frame in order,
+        in the coordinates of the frame.
+        """
+        image = self.prepare_input(frames)
 
         with torch.no_grad():
             pred = self.model(image)[0]
+        if self.use_cuda:
+            # Kernels run asynchronously; wait so that the time is not charged to the next stage
+            torch.cuda.synchronize(self.device)
+        return pred
+
+    def suppress(self, pred):
+        with torch.no_grad():
             pred = non_max_suppression(
                 pred,
                 self.det_thr,
@@ -54,4 +108,10 @@ class YOLOv7_Main():
                 classes=[2, 3, 5, 7], # Vehicles (see coco.names)
                 agnostic=True
             )
-        return pred
\ No newline at end of file
+            # Boxes back from the letterboxed input to the frames of the last infer_batch
+            for det, shape, ratio_pad in zip(pred, self.frame_shapes, self.ratio_pads):
+                scale_coords(self.size[::-1], det[:, :4], shape, ratio_pad)
+        return pred
+
+    def run(self, frame):
+        return self.suppress(self.infer(frame))
\ No newline at end of file
@@ -0,0 +1,83 @@
+import time
+
+import numpy as np
+
+
+class StageTimer:
+    """ StageTimer measures the latency of a stage with the monotonic clock.
+    The most recent latencies are kept in a fixed-size window for percentiles.
+    """
+    def __init__(self, name, window=1024):
+        self.name = name
+        self.latencies = np.zeros(window)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self._start = 0.
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.record(time.monotonic() - self._start)
+        return False
+
+    def record(self, elapsed):
+        self.latencies[self.count % len(self.latencies)] = elapsed
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def summary(self):
+        """ summary returns p50, p95 and max latency in seconds and the effective FPS of the stage
+        """
+        if self.count == 0:
+            return {"p50": 0., "p95": 0., "max": 0., "fps": 0.}
+        window = self.latencies[:min(self.count, len(self.latencies))]
+        p50, p95 = np.percentile(window, [50, 95])
+        fps = self.count / self.total if self.total > 0 else 0.
+        return {"p50": float(p50), "p95": float(p95), "max": float(self.max), "fps": float(fps)}
+
+
+class Profiler:
+    """ Profiler keeps a StageTimer per stage of the pipeline
+    """
+    def __init__(self, window=1024):
+        self.window = window
+        self.stages = {}
+
+    def stage(self, name):
+        timer = self.stages.get(name)
+        if timer is None:
+            timer = StageTimer(name, self.window)
+            self.stages[name] = timer
+        return timer
+
+    def iterate(self, name, iterable):
+        """ iterate yields from the iterable, timing how long each item takes to produce,
+        e.g. decoding frames of a video stream
+        """
+        timer = self.stage(name)
+        iterator = iter(iterable)
+        while True:
+            start = time.monotonic()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            timer.record(time.monotonic() - start)
+            yield item
+
+    def summary(self):
+        return {name: timer.summary() for name, timer in self.stages.items()}
+
+    def publish(self, plugin, prefix="sys.plugin.trafficcounter", timestamp=None):
+        """ publish sends the summary of each stage as {prefix}.{stage}.{p50,p95,max,fps}.
+        Latencies are in seconds.
+        """
+        for name, summary in self.summary().items():
+            for key, value in summary.items():
+                unit = "fps" if key == "fps" else "seconds"
+                plugin.publish(f"{prefix}.{name}.{key}", value, meta={"unit": unit}, timestamp=timestamp)
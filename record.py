@@ -1,18 +1,196 @@
 #!/usr/bin/env python3
 
+import glob
 import os
 import re
 import time
+import json
 import argparse
 import logging
+import threading
+from collections import namedtuple
+from fractions import Fraction
+from pathlib import Path
 
+import cv2
 import ffmpeg
 
 from waggle.data.vision import resolve_device
 from waggle.data.timestamp import get_timestamp
 
 
-def take_sample(stream, duration, skip_second=0):
+StreamInfo = namedtuple('StreamInfo', ['fps', 'width', 'height', 'codec'])
+
+
+def probe_stream(stream_url):
+    """ probe_stream returns the StreamInfo of the first video stream of a URL or file.
+    It raises ffmpeg.Error if ffprobe fails, and KeyError, ValueError or ZeroDivisionError
+    if the stream has no usable video.
+    """
+    if stream_url.startswith("rtsp"):
+        probe = ffmpeg.probe(stream_url, select_streams='v:0', rtsp_transport="tcp")
+    else:
+        probe = ffmpeg.probe(stream_url, select_streams='v:0')
+    video = probe['streams'][0] if probe['streams'] else {}
+    return StreamInfo(
+        # r_frame_rate is a fraction such as 30000/1001, and 0/0 if unknown
+        fps=float(Fraction(video['r_frame_rate'])),
+        width=int(video['width']),
+        height=int(video['height']),
+        codec=video.get('codec_name', ''))
+
+
+def parse_stream_info(log):
+    """ parse_stream_info returns the StreamInfo of the first video stream of the first input
+    in the log of an ffmpeg run, which describes its inputs as it opens them, e.g.
+    `Stream #0:0: Video: h264 (Main), yuv420p(progressive), 1920x1080, 30 fps, 30 tbr, 90k tbn`,
+    or None if the log does not tell all of it
+    """
+    for line in log.split("Output #0")[0].splitlines():
+        if not line.lstrip().startswith("Stream #0:") or ": Video: " not in line:
+            continue
+        codec = re.search(r": Video: (\w+)", line)
+        size = re.search(r", (\d+)x(\d+)", line)
+        # tbr is the frame rate that ffmpeg guesses when the stream tells none
+        fps = re.search(r", ([\d.]+)(k?) fps", line) or re.search(r", ([\d.]+)(k?) tbr", line)
+        if codec is None or size is None or fps is None:
+            return None
+        return StreamInfo(
+            fps=float(fps.group(1)) * (1000 if fps.group(2) == "k" else 1),
+            width=int(size.group(1)),
+            height=int(size.group(2)),
+            codec=codec.group(1))
+    return None
+
+
+def capture_info(path):
+    """ capture_info returns the StreamInfo of a video as OpenCV, which waggle's Camera reads
+    it with, opens it, or None if it cannot be opened
+    """
+    capture = cv2.VideoCapture(str(path))
+    try:
+        if not capture.isOpened():
+            return None
+        fourcc = int(capture.get(cv2.CAP_PROP_FOURCC))
+        return StreamInfo(
+            fps=capture.get(cv2.CAP_PROP_FPS),
+            width=int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            height=int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            codec="".join(chr((fourcc >> 8 * i) & 0xFF) for i in range(4)).strip("\x00 ").lower())
+    finally:
+        capture.release()
+
+
+class StreamSession:
+    """ StreamSession probes a stream once and keeps its StreamInfo in a JSON cache shared
+    by runs, so that a run reads the stream or its recording without a probe of its own.
+    Entries expire after ttl seconds; an entry of a local file also expires when the file
+    changes. The cache only helps if its file outlives the run, e.g. on a mounted volume.
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, stream, cache_path="", ttl=3600.):
+        self.stream = stream
+        if isinstance(stream, str) and os.path.exists(stream):
+            # A local file rather than the name of a stream
+            stream = Path(stream)
+        self.stream_url = resolve_device(stream)
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self._info = None
+
+    def _file_stamp(self):
+        try:
+            stat = os.stat(self.stream_url)
+        except OSError:
+            return None
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def _load_cache(self):
+        if self.cache_path == "" or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path) as fp:
+                return json.load(fp)
+        except (OSError, json.JSONDecodeError) as e:
+            logging.warning(f"Ignoring stream cache {self.cache_path}: {e}")
+            return {}
+
+    def _save_cache(self, cache):
+        # Written aside and renamed so that a concurrent run never reads half a file
+        directory = os.path.dirname(os.path.abspath(self.cache_path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(cache, fp, indent=2)
+        os.replace(tmp_path, self.cache_path)
+
+    def info(self, path=None):
+        """ info returns the StreamInfo of the stream from the cache, or probes it and caches it.
+        A recording of the stream is given as path to probe it rather than the live stream. If
+        ffprobe fails, the info is read with OpenCV and is not cached. It returns None if the
+        video cannot be read either way.
+        """
+        if self._info is not None:
+            return self._info
+        target = self.stream_url if path is None else str(path)
+        stamp = self._file_stamp()
+        with StreamSession._lock:
+            cache = self._load_cache()
+            entry = cache.get(self.stream_url)
+            if entry is not None and time.time() - entry["probed"] < self.ttl and entry.get("file") == stamp:
+                self._info = StreamInfo(*entry["info"])
+                logging.info(f"Using cached stream info of {self.stream_url}: {self._info}")
+                return self._info
+            try:
+                self._info = probe_stream(target)
+            except ffmpeg.Error as e:
+                logging.warning(f"Failed to probe {target}: {e.stderr.decode(errors='replace').strip() if e.stderr else e}")
+            except (KeyError, ValueError, ZeroDivisionError, OSError) as e:
+                # OSError if ffprobe is not installed
+                logging.warning(f"Failed to read the video stream info of {target}: {type(e).__name__}: {e}")
+            if self._info is None:
+                self._info = capture_info(target)
+                if self._info is None:
+                    logging.error(f"Failed to open {target}")
+                else:
+                    logging.info(f"Read the info of {target} with OpenCV: {self._info}")
+                return self._info
+            logging.info(f"Probed {target}: {self._info}")
+            self._cache_info(cache, stamp)
+        return self._info
+
+    def _cache_info(self, cache, stamp):
+        if self.cache_path != "":
+            cache[self.stream_url] = {"info": list(self._info), "probed": time.time(), "file": stamp}
+            self._save_cache(cache)
+
+    def take_sample(self, duration, skip_second=0, filename='sample.mp4'):
+        """ take_sample records a sample of the stream as take_sample does, and keeps the info
+        of the stream that ffmpeg tells when it opens it, so that info needs no probe after it
+        """
+        result, filename, timestamp, info = record_sample(
+            self.stream, duration, skip_second=skip_second, filename=filename)
+        if result and self._info is None and info is not None:
+            self._info = info
+            logging.info(f"Read the info of {self.stream_url} from ffmpeg: {self._info}")
+            with StreamSession._lock:
+                self._cache_info(self._load_cache(), self._file_stamp())
+        return result, filename, timestamp
+
+    def segment_recorder(self, directory, segment_time=5., wrap=10):
+        return SegmentRecorder(self.stream, directory, segment_time=segment_time, wrap=wrap)
+
+
+def take_sample(stream, duration, skip_second=0, filename='sample.mp4'):
+    result, filename, timestamp, _ = record_sample(stream, duration, skip_second, filename)
+    return result, filename, timestamp
+
+
+def record_sample(stream, duration, skip_second=0, filename='sample.mp4'):
+    """ record_sample is take_sample that also returns the StreamInfo of the stream from the
+    log of ffmpeg, or None if the log does not tell it
+    """
     stream_url = resolve_device(stream)
     # Assume PyWaggle's timestamp is in nano seconds
     timestamp = get_timestamp() + int(skip_second * 1e9)
@@ -20,13 +198,14 @@ def take_sample(stream, duration, skip_second=0):
         script_dir = os.path.dirname(__file__)
     except NameError:
         script_dir = os.getcwd()
-    filename = os.path.join(script_dir, 'sample.mp4')
+    filename = os.path.join(script_dir, filename)
 
-    # To prevent corruption in frames we prefer tcp transfer for rtsp
+    # To prevent corruption in frames we prefer tcp transfer for rtsp.
+    # stimeout is an option of rtsp only, which ffmpeg rejects for other inputs
     if stream_url.startswith("rtsp"):
         c = ffmpeg.input(stream_url, rtsp_transport="tcp", ss=skip_second, stimeout=5000000)
     else:
-        c = ffmpeg.input(stream_url, ss=skip_second, stimeout=5000000)
+        c = ffmpeg.input(stream_url, ss=skip_second)
     c = ffmpeg.output(
         c,
         filename,
@@ -34,12 +213,129 @@ def take_sample(stream, duration, skip_second=0):
         f='mp4',
         t=duration).overwrite_output()
     logging.info("Running command: %s", c.compile())
-    (out, err) = c.run(quiet=True, capture_stdout=True, capture_stderr=True)
-    if err:
-        logging.info("%s", out.decode())
-        logging.error("Error: %s", err.decode())
-        return False, filename, timestamp
-    return True, filename, timestamp
+    # ffmpeg logs its banner and the inputs to stderr even when it succeeds,
+    # so only its exit status tells a failure
+    try:
+        (out, err) = c.run(quiet=True, capture_stdout=True, capture_stderr=True)
+    except ffmpeg.Error as e:
+        logging.info("%s", e.stdout.decode(errors='replace'))
+        logging.error("Error: %s", e.stderr.decode(errors='replace'))
+        return False, filename, timestamp, None
+    return True, filename, timestamp, parse_stream_info(err.decode(errors='replace'))
+
+
+def file_generation(path):
+    """ file_generation returns the inode, modification time and size of a file, which change
+    when the file is rewritten, or None if the file does not exist
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+class SegmentRecorder:
+    """ SegmentRecorder captures a stream into short segments in a directory, e.g. on tmpfs
+    such as /dev/shm, instead of one sample.mp4 on the storage of the node. ffmpeg writes
+    the segments as a ring of wrap files and lists each segment in segments.csv when it
+    closes, so that segments can be processed while the capture goes on. stop removes
+    the segments and the list, and the directory once it is empty.
+    """
+    def __init__(self, stream, directory, segment_time=5., wrap=10):
+        self.stream = stream
+        self.directory = directory
+        self.segment_time = segment_time
+        self.wrap = wrap
+        self.list_path = os.path.join(directory, 'segments.csv')
+        self.process = None
+        self.timestamp = None
+
+    def start(self, duration):
+        """ start runs ffmpeg in the background to capture the stream for duration seconds
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.list_path):
+            os.remove(self.list_path)
+        stream_url = resolve_device(self.stream)
+        if stream_url.startswith("rtsp"):
+            c = ffmpeg.input(stream_url, rtsp_transport="tcp", stimeout=5000000)
+        else:
+            c = ffmpeg.input(stream_url)
+        c = ffmpeg.output(
+            c,
+            os.path.join(self.directory, 'segment%03d.mp4'),
+            codec="copy", # use same codecs of the original video
+            f='segment',
+            segment_time=self.segment_time,
+            segment_wrap=self.wrap,
+            segment_list=self.list_path,
+            segment_list_type='csv',
+            segment_format='mp4',
+            reset_timestamps=1,
+            t=duration).global_args('-loglevel', 'error').overwrite_output()
+        logging.info("Running command: %s", c.compile())
+        # Assume PyWaggle's timestamp is in nano seconds
+        self.timestamp = get_timestamp()
+        self.process = c.run_async()
+
+    def segments(self, poll_interval=0.2):
+        """ segments yields the path and the timestamp of each segment as it closes, until the
+        capture ends. A segment is deleted once the caller asks for the next one, unless ffmpeg
+        has already reused its file for a newer segment.
+        """
+        offset = 0
+        pending = []
+        while True:
+            exited = self.process.poll() is not None
+            if os.path.exists(self.list_path):
+                with open(self.list_path) as fp:
+                    fp.seek(offset)
+                    lines = fp.read()
+                # Only complete lines; ffmpeg may be in the middle of writing one
+                complete = lines[:lines.rfind("\n") + 1]
+                offset += len(complete)
+                for line in complete.splitlines():
+                    filename, start, _ = line.split(",")
+                    path = os.path.join(self.directory, filename)
+                    if any(entry[0] == path for entry in pending):
+                        # Listed again, so the file now holds the newer segment
+                        logging.warning(f"Segment {path} was overwritten before it was processed")
+                        pending = [entry for entry in pending if entry[0] != path]
+                    # The file of the closed segment, told apart from a newer segment in the same file
+                    pending.append((path, self.timestamp + int(float(start) * 1e9), file_generation(path)))
+            if len(pending) >= self.wrap:
+                logging.warning(f"{len(pending)} segments are waiting; ffmpeg may overwrite them before they are processed")
+            if len(pending) > 0:
+                path, timestamp, generation = pending.pop(0)
+                if generation is None or file_generation(path) != generation:
+                    logging.warning(f"Segment {path} was overwritten before it was processed")
+                    continue
+                yield path, timestamp
+                if file_generation(path) == generation:
+                    os.remove(path)
+            elif exited:
+                if self.process.returncode != 0:
+                    logging.error(f"ffmpeg exited with {self.process.returncode}")
+                return
+            else:
+                time.sleep(poll_interval)
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        paths = glob.glob(os.path.join(self.directory, 'segment[0-9][0-9][0-9].mp4')) + [self.list_path]
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        try:
+            os.rmdir(self.directory)
+        except OSError:
+            # Not empty, e.g. /dev/shm itself, or already removed
+            pass
 
 
 if __name__=='__main__':
@@ -0,0 +1,200 @@
+""" Parameter sweep of the tracker and counter over archived clips.
+
+Each clip is detected once and its detections are cached with DetectionWriter.
+Every combination of the tracker parameters and lane configs is then replayed
+on every clip in a pool of worker processes, which memory-map the cached
+detections, and the count error against the labeled totals is aggregated per
+combination.
+
+A clip is labeled by a JSON file next to it with the same stem,
+    clip.mp4          the clip
+    clip.lanes.json   lanes config, unless --lanes-files is given
+    clip.truth.json   {"total": 12, "per_lane": {"lane0": 3, ...}}
+
+    python3 sweep.py --clips data/*.mp4 --max-age 10 15 20 --min-hits 2 3 --output sweep.json
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+from waggle.data.vision import Camera
+
+from app import TrafficCounter, load_class_names, parse_img_size, replay_detections
+from coordinates import load_lanes_config
+from models.sort import Sort
+from profiling import Profiler
+from detections import DetectionWriter, DetectionReader
+
+
+def cache_path(cache_dir, clip):
+    return Path(cache_dir) / Path(clip).stem
+
+
+def cache_detections(clip, detector, path):
+    """ cache_detections runs the detector over the clip and saves the detections in path
+    """
+    writer = DetectionWriter(path)
+    with Camera(Path(clip)) as camera:
+        for sample in camera.stream():
+            # Boxes are in the coordinates of the frames
+            writer.meta["space"] = [sample.data.shape[1], sample.data.shape[0]]
+            detections = detector.suppress(detector.infer(sample.data))
+            writer.write(np.asarray(detections[0].cpu().detach()), sample.timestamp)
+    writer.close(input=str(clip))
+
+
+def count_error(counts, ground_truth):
+    per_lane = {}
+    for lane in set(ground_truth.get("per_lane", {})) | set(counts.per_lane):
+        per_lane[lane] = counts.per_lane.get(lane, 0) - ground_truth.get("per_lane", {}).get(lane, 0)
+    total = counts.total - ground_truth["total"]
+    return {
+        "total": total,
+        "total_relative": total / ground_truth["total"] if ground_truth["total"] > 0 else 0.,
+        "per_lane": per_lane,
+        "per_lane_absolute": sum(abs(e) for e in per_lane.values()),
+    }
+
+
+def init_worker():
+    # Workers scale by processes; threads within a worker would only compete for the cores
+    cv2.setNumThreads(1)
+
+
+def run_job(job):
+    """ run_job replays the cached detections of a clip with a set of parameters
+    """
+    detection_reader = DetectionReader(job["detections"])
+    mot_tracker = Sort(max_age=job["max_age"], min_hits=job["min_hits"], iou_threshold=job["iou_threshold"])
+    lanes, lanes_space = load_lanes_config(job["lanes"])
+    traffic_counter = TrafficCounter(lanes, job["class_names"], space=lanes_space)
+    replay_detections(detection_reader, mot_tracker, traffic_counter, Profiler())
+    counts = traffic_counter.report_results()
+    return {
+        "clip": job["clip"],
+        "counts": {"total": counts.total, "per_lane": counts.per_lane},
+        "error": count_error(counts, job["truth"]),
+    }
+
+
+def aggregate(results):
+    """ aggregate returns the mean errors over the clips of a parameter set
+    """
+    total = np.array([r["error"]["total"] for r in results], dtype=float)
+    relative = np.array([r["error"]["total_relative"] for r in results], dtype=float)
+    per_lane = np.array([r["error"]["per_lane_absolute"] for r in results], dtype=float)
+    return {
+        "clips": len(results),
+        "mean_total_error": float(total.mean()),
+        "mean_absolute_total_error": float(np.abs(total).mean()),
+        "mean_absolute_relative_error": float(np.abs(relative).mean()),
+        "mean_per_lane_absolute_error": float(per_lane.mean()),
+    }
+
+
+def main(args):
+    clips = [Path(clip) for clip in args.clips]
+    class_names = load_class_names(args.labels)
+
+    # Step: Detect each clip once
+    detector = None
+    for clip in clips:
+        path = cache_path(args.cache, clip)
+        if (path / "meta.json").exists():
+            continue
+        if detector is None:
+            from models.yolov7 import YOLOv7_Main
+            detector = YOLOv7_Main(args.model, args.det_thr, args.iou_thres, img_size=parse_img_size(args.img_size))
+        logging.info(f"Caching detections of {clip} in {path}")
+        cache_detections(clip, detector, path)
+    del detector
+
+    if args.lanes_files:
+        lane_configs = {str(path): json.loads(path.read_text()) for path in args.lanes_files}
+    else:
+        lane_configs = {"clip": None}
+
+    jobs = []
+    for clip in clips:
+        truth = json.loads(clip.with_suffix(".truth.json").read_text())
+        for (lanes_name, lanes), max_age, min_hits, iou_threshold in itertools.product(
+                lane_configs.items(), args.max_age, args.min_hits, args.iou_threshold):
+            if lanes is None:
+                lanes = json.loads(clip.with_suffix(".lanes.json").read_text())
+            jobs.append({
+                "clip": str(clip),
+                "detections": str(cache_path(args.cache, clip)),
+                "truth": truth,
+                "lanes_name": lanes_name,
+                "lanes": lanes,
+                "class_names": class_names,
+                "max_age": max_age,
+                "min_hits": min_hits,
+                "iou_threshold": iou_threshold,
+            })
+
+    # Step: Replay every job in the pool
+    logging.info(f"Running {len(jobs)} jobs on {args.workers} workers")
+    start = time.monotonic()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker) as executor:
+        results = list(executor.map(run_job, jobs, chunksize=max(1, len(jobs) // (4 * args.workers))))
+    elapsed = time.monotonic() - start
+    logging.info(f"Ran {len(jobs)} jobs in {elapsed:.1f} seconds")
+
+    # Step: Aggregate the errors per parameter set
+    groups = {}
+    for job, result in zip(jobs, results):
+        key = (job["lanes_name"], job["max_age"], job["min_hits"], job["iou_threshold"])
+        groups.setdefault(key, []).append(result)
+    report = []
+    for (lanes_name, max_age, min_hits, iou_threshold), group in groups.items():
+        summary = aggregate(group)
+        summary.update({"lanes": lanes_name, "max_age": max_age, "min_hits": min_hits, "iou_threshold": iou_threshold})
+        report.append(summary)
+    report.sort(key=lambda s: (s["mean_absolute_total_error"], s["mean_per_lane_absolute_error"]))
+
+    for summary in report[:args.top]:
+        logging.info(f"lanes {summary['lanes']}, max-age {summary['max_age']}, min-hits {summary['min_hits']}, "
+                     f"iou-threshold {summary['iou_threshold']}: mean absolute error {summary['mean_absolute_total_error']:.2f} "
+                     f"({summary['mean_absolute_relative_error'] * 100:.1f}%), per lane {summary['mean_per_lane_absolute_error']:.2f}")
+    if args.output is not None:
+        args.output.write_text(json.dumps({"elapsed": elapsed, "jobs": len(jobs), "workers": args.workers, "results": report}, indent=2))
+        logging.info(f"Report written to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parameter sweep of the traffic counter over cached detections')
+    parser.add_argument('--clips', type=Path, nargs='+', required=True, help='Labeled clips')
+    parser.add_argument('--cache', type=Path, default=Path('detections'), help='Directory of cached detections')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes')
+    parser.add_argument('--output', type=Path, default=None, help='Path to the JSON report')
+    parser.add_argument('--top', type=int, default=10, help='Number of best parameter sets to log')
+
+    # Detection, only for clips without cached detections
+    parser.add_argument('--model', type=Path, default=Path('model.pt'))
+    parser.add_argument('--labels', type=Path, default=Path('coco.names'))
+    parser.add_argument("--detection-thres", dest='det_thr', type=float, default=0.5)
+    parser.add_argument('--iou-thres', type=float, default=0.45, help='IOU threshold for NMS')
+    parser.add_argument('--img-size', type=str, default='640', help='Input size of the detector as WIDTHxHEIGHT')
+
+    # Parameters to sweep
+    parser.add_argument('--max-age', type=int, nargs='+', default=[15])
+    parser.add_argument('--min-hits', type=int, nargs='+', default=[3])
+    parser.add_argument('--iou-threshold', type=float, nargs='+', default=[0.3])
+    parser.add_argument('--lanes-files', type=Path, nargs='+', default=None,
+        help='Lanes configs to sweep; each clip uses its own if not given')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(message)s',
+        datefmt='%Y/%m/%d %H:%M:%S')
+    exit(main(args))
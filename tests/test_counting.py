@@ -0,0 +1,149 @@
+import numpy as np
+import pytest
+
+from app import TrafficCounter, VehicleTable, crossing_directions
+from models.sort import TrackEvent
+
+
+# A count line along x; with y growing downward, its right is below it
+LINE = np.array([[0., 100., 200., 100.]])
+
+
+def directions(path):
+    """ directions returns the crossing of LINE by each move along the path of points
+    """
+    points = np.asarray(path, dtype=float)
+    return crossing_directions(points[:-1], points[1:], LINE)[:, 0].tolist()
+
+
+def test_crossing_left_to_right():
+    assert directions([(50, 90), (50, 110)]) == [1]
+
+
+def test_crossing_right_to_left():
+    assert directions([(50, 110), (50, 90)]) == [-1]
+
+
+def test_move_beside_the_segment_does_not_cross():
+    assert directions([(250, 90), (250, 110)]) == [0]
+    assert directions([(50, 90), (60, 95)]) == [0]
+
+
+def test_stop_on_the_line_from_the_left():
+    # A point on the line belongs to its left, so the crossing is once it moves off
+    assert directions([(50, 90), (50, 100), (50, 100), (50, 110)]) == [0, 0, 1]
+
+
+def test_stop_on_the_line_from_the_right():
+    # Counted as it stops, and not again as it goes on
+    assert directions([(50, 110), (50, 100), (50, 100), (50, 90)]) == [-1, 0, 0]
+
+
+def test_crossings_of_many_segments_at_once():
+    segments = np.array([[0., 100., 200., 100.], [100., 0., 100., 200.]])
+    p0 = np.array([[50., 90.], [90., 50.]])
+    p1 = np.array([[50., 110.], [110., 50.]])
+    # The second segment runs downward, so its right is to the left on the image
+    np.testing.assert_array_equal(crossing_directions(p0, p1, segments), [[1, 0], [0, -1]])
+
+
+def box_at(x, y):
+    # A box whose reference point, the middle of its lower half, is (x, y)
+    return [x - 10., y - 30., x + 10., y + 10.]
+
+
+def run_counter(paths, events=()):
+    """ run_counter moves tracks along paths, one point per frame, and returns the counter
+    """
+    counter = TrafficCounter([{"name": "count", "points": [[0, 100], [200, 100]]}], ["car"])
+    counter.finalize(events)
+    for frame in range(max(len(path) for path in paths.values())):
+        trackers = np.array([box_at(*path[frame]) + [track_id, 0]
+            for track_id, path in paths.items() if frame < len(path)])
+        counter.update(trackers)
+    return counter
+
+
+def test_counter_counts_each_direction():
+    counts = run_counter({1: [(50, 90), (50, 110)], 2: [(150, 110), (150, 90)]}).report_results()
+    assert counts.total == 2
+    assert counts.per_direction == {"inbound": 1, "outbound": 1}
+
+
+def test_counter_counts_a_stop_on_the_line_once():
+    counts = run_counter({1: [(50, 110), (50, 100), (50, 100), (50, 90), (50, 80)]}).report_results()
+    assert counts.per_direction == {"outbound": 1}
+
+
+def test_counter_keeps_the_net_crossing():
+    # Over the line and back is not counted
+    counts = run_counter({1: [(50, 90), (50, 110), (50, 90)]}).report_results()
+    assert counts.total == 0
+
+
+def test_counter_counts_a_crossing_before_the_track_is_confirmed():
+    born = TrackEvent("born", 1, 0, np.array(box_at(50, 90) + [0.9, 0]), 0, 1, 1)
+    counts = run_counter({1: [(50, 110), (50, 115)]}, events=[born]).report_results()
+    assert counts.per_direction == {"inbound": 1}
+
+
+def test_counter_moves_terminated_vehicles_into_the_counts():
+    counter = run_counter({1: [(50, 90), (50, 110)]})
+    counter.finalize([TrackEvent("terminated", 1, 2, np.array(box_at(50, 110) + [0.9, 0]), 0, 2, 2)])
+    assert len(counter.table) == 0
+    assert counter.counts.total == 1
+    assert counter.report_results().total == 1
+
+
+def test_table_reuses_released_rows():
+    table = VehicleTable(num_lanes=2, trajectory_size=4, capacity=4)
+    rows = table.get_rows([10., 11., 12.])
+    np.testing.assert_array_equal(rows, [0, 1, 2])
+    table.cross_gate(rows[1], 0, 1, count_gate=0)
+    table.lane_scores[rows[1]] = [3, 1]
+    table.trajectories.append(rows, np.ones((3, 2)), 1.)
+
+    table.release([rows[1]])
+    assert len(table) == 2
+    reused = table.get_rows([13.])
+    assert reused.tolist() == [rows[1]]
+    row = reused[0]
+    # The row holds nothing of the vehicle it held before
+    assert table.ids[row] == 13.
+    assert table.crossings[row] == 0
+    assert table.origins[row] == -1
+    assert table.lane_scores[row].tolist() == [0, 0]
+    assert table.trajectories.sizes[row] == 0
+    assert table.trajectories.sizes[rows[0]] == 1
+    assert table.capacity == 4
+    assert table.rows == {10.: 0, 12.: 2, 13.: 1}
+
+
+def test_table_grows_keeping_rows():
+    table = VehicleTable(num_lanes=1, capacity=2)
+    rows = table.get_rows([1., 2.])
+    table.crossings[rows] = [1, -1]
+    assert table.get_rows([3.]).tolist() == [2]
+    assert table.capacity == 4
+    assert table.crossings[:3].tolist() == [1, -1, 0]
+    assert table.get_rows([2., 1.]).tolist() == [1, 0]
+
+
+def test_net_crossing_is_bounded():
+    table = VehicleTable(num_lanes=0)
+    row = table.get_rows([1.])[0]
+    for _ in range(3):
+        table.cross_gate(row, 0, 1, count_gate=0)
+    assert table.crossings[row] == 1
+    table.cross_gate(row, 0, -1, count_gate=0)
+    assert table.crossings[row] == 0
+
+
+@pytest.mark.parametrize("trajectory_size", [2, 4])
+def test_trajectories_keep_the_most_recent_points(trajectory_size):
+    table = VehicleTable(num_lanes=0, trajectory_size=trajectory_size)
+    row = table.get_rows([1.])[0]
+    for t in range(5):
+        table.trajectories.append(row, [t, t], t)
+    points, timestamps = table.trajectories.ordered(row)
+    assert timestamps.tolist() == list(range(5 - trajectory_size, 5))
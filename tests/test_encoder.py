@@ -0,0 +1,114 @@
+import pytest
+
+from encoder import EventPolicy, EveryNthPolicy, OutputPolicy
+
+
+class FakeWriter:
+    def __init__(self):
+        self.frames = []
+        self.released = False
+
+    def write(self, frame):
+        self.frames.append(frame)
+
+    def release(self):
+        self.released = True
+
+
+class FakeFrame:
+    """ FakeFrame renders to its index and records whether it was rendered or kept
+    """
+    def __init__(self, index):
+        self.index = index
+        self.rendered = False
+        self.kept = False
+
+    def render(self):
+        self.rendered = True
+        return self.index
+
+    def keep(self):
+        self.kept = True
+        return self
+
+
+def run_policy(policy, frames, events):
+    """ run_policy passes the frames that the policy wants, with the events at the given indices,
+    and returns the frames passed
+    """
+    passed = []
+    for i in range(frames):
+        if policy.wants(i):
+            frame = FakeFrame(i)
+            passed.append(frame)
+            policy.write(frame, event=i in events)
+    return passed
+
+
+def test_all_policy_writes_every_frame():
+    writer = FakeWriter()
+    run_policy(OutputPolicy(writer), 5, events=set())
+    assert writer.frames == [0, 1, 2, 3, 4]
+
+
+def test_every_nth_policy():
+    writer = FakeWriter()
+    passed = run_policy(EveryNthPolicy(writer, 3), 10, events=set())
+    assert writer.frames == [0, 3, 6, 9]
+    assert [frame.index for frame in passed] == [0, 3, 6, 9]
+
+
+def test_event_policy_writes_pre_and_post_roll():
+    writer = FakeWriter()
+    run_policy(EventPolicy(writer, pre_roll=2, post_roll=3), 20, events={10})
+    assert writer.frames == [8, 9, 10, 11, 12, 13]
+
+
+def test_event_policy_pre_roll_at_the_start():
+    writer = FakeWriter()
+    run_policy(EventPolicy(writer, pre_roll=5, post_roll=1), 10, events={2})
+    assert writer.frames == [0, 1, 2, 3]
+
+
+def test_event_policy_extends_post_roll_on_a_new_event():
+    writer = FakeWriter()
+    run_policy(EventPolicy(writer, pre_roll=1, post_roll=2), 20, events={5, 7})
+    assert writer.frames == [4, 5, 6, 7, 8, 9]
+
+
+def test_event_policy_writes_separate_windows():
+    writer = FakeWriter()
+    run_policy(EventPolicy(writer, pre_roll=1, post_roll=1), 20, events={3, 12})
+    assert writer.frames == [2, 3, 4, 11, 12, 13]
+
+
+def test_event_policy_without_pre_roll():
+    writer = FakeWriter()
+    passed = run_policy(EventPolicy(writer, pre_roll=0, post_roll=1), 10, events={4})
+    assert writer.frames == [4, 5]
+    assert not any(frame.kept for frame in passed)
+
+
+def test_event_policy_renders_only_the_frames_written():
+    writer = FakeWriter()
+    passed = run_policy(EventPolicy(writer, pre_roll=2, post_roll=1), 20, events={10})
+    assert [frame.index for frame in passed if frame.rendered] == [8, 9, 10, 11]
+    # Frames outside of the post roll are kept for the pre roll
+    assert all(frame.kept for frame in passed if frame.index < 10 or frame.index > 11)
+
+
+@pytest.mark.parametrize("max_frames", [1, 3])
+def test_highlights_stop_at_max_frames(max_frames):
+    writer = FakeWriter()
+    policy = EventPolicy(writer, pre_roll=2, post_roll=2, max_frames=max_frames)
+    run_policy(policy, 30, events={5, 20})
+    assert writer.frames == [3, 4, 5][:max_frames]
+    assert policy.full()
+    assert not policy.wants(30)
+
+
+def test_release_releases_the_writer():
+    writer = FakeWriter()
+    policy = EventPolicy(writer)
+    policy.release()
+    assert writer.released
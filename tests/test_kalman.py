@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from models.kalman import KalmanBoxFilter
+from models.sort import KalmanBoxTracker, convert_bbox_to_z
+
+
+R_DIAG, Q_POS, Q_VEL = 0.15, 0.0106123, 0.016327
+
+
+def make_filter(dt):
+    kf = KalmanBoxFilter(R_DIAG, Q_POS, Q_VEL, P_pos=1.0, P_vel=0.96, dt=dt)
+    kf.x[:4, 0] = [10., 20., 300., 1.5]
+    return kf
+
+
+def reference_step(x, P, z, dt):
+    # The generic Kalman equations with the matrices of the box model
+    F = np.eye(7)
+    F[0, 4] = F[1, 5] = F[2, 6] = dt
+    H = np.eye(7)[:4]
+    Q = np.diag([Q_POS] * 3 + [Q_VEL] * 4)
+    R = np.eye(4) * R_DIAG
+    x = F @ x
+    P = F @ P @ F.T + Q
+    S = H @ P @ H.T + R
+    K = P @ H.T @ np.linalg.inv(S)
+    x = x + K @ (z - H @ x)
+    P = (np.eye(7) - K @ H) @ P
+    return x, P
+
+
+def test_predict_without_velocity_adds_process_noise():
+    kf = make_filter(dt=0.)
+    kf.predict()
+    np.testing.assert_allclose(kf.x.ravel(), [10., 20., 300., 1.5, 0., 0., 0.])
+    np.testing.assert_allclose(kf.P.diagonal(), [1.0106123] * 3 + [1.016327] + [0.976327] * 3)
+
+
+def test_update_without_velocity():
+    kf = make_filter(dt=0.)
+    kf.predict()
+    kf.update(np.array([[12.], [20.], [300.], [1.5]]))
+    # gain = P / (P + R) with P = 1 + Q_POS
+    gain = 1.0106123 / (1.0106123 + R_DIAG)
+    np.testing.assert_allclose(kf.x.ravel(), [10. + 2. * gain, 20., 300., 1.5, 0., 0., 0.])
+    assert kf.x[0, 0] == pytest.approx(11.74151575)
+    assert kf.P[0, 0] == pytest.approx(1.0106123 * R_DIAG / (1.0106123 + R_DIAG))
+
+
+def test_constant_velocity_step():
+    kf = make_filter(dt=1.)
+    kf.predict()
+    # P_pp = 1 + P_vv + Q_POS, P_pv = P_vv
+    assert kf.P[0, 0] == pytest.approx(1.9706123)
+    assert kf.P[0, 4] == pytest.approx(0.96)
+    assert kf.P[4, 4] == pytest.approx(0.976327)
+    kf.update(np.array([[12.], [20.], [300.], [1.5]]))
+    assert kf.x[0, 0] == pytest.approx(10. + 2. * 1.9706123 / (1.9706123 + R_DIAG))
+    assert kf.x[4, 0] == pytest.approx(2. * 0.96 / (1.9706123 + R_DIAG))
+    assert kf.x[4, 0] == pytest.approx(0.90539888)
+
+
+@pytest.mark.parametrize("dt", [0., 1.])
+def test_matches_generic_kalman_filter(dt):
+    kf = make_filter(dt)
+    x, P = kf.x.copy(), kf.P
+    rng = np.random.default_rng(0)
+    for t in range(20):
+        box = np.array([100. + 3 * t, 200. + t, 160. + 3 * t, 240. + t]) + rng.normal(0, 2, 4)
+        z = convert_bbox_to_z(box)
+        kf.predict()
+        kf.update(z)
+        x, P = reference_step(x, P, z, dt)
+        np.testing.assert_allclose(kf.x, x, rtol=1e-9, atol=1e-9)
+        np.testing.assert_allclose(kf.P, P, rtol=1e-9, atol=1e-9)
+
+
+def test_tracker_predicts_the_box_it_was_given():
+    tracker = KalmanBoxTracker(np.array([100., 200., 160., 240., 0.9, 2.]))
+    np.testing.assert_allclose(tracker.predict(), [[100., 200., 160., 240.]])
+    assert tracker.time_since_update == 1
+    tracker.update(np.array([104., 200., 164., 240., 0.9, 2.]))
+    assert tracker.time_since_update == 0
+    assert tracker.hits == 1
+    assert 100. < tracker.get_state()[0, 0] < 104.
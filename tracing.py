@@ -0,0 +1,91 @@
+import json
+import logging
+from collections import deque
+
+import numpy as np
+
+
+class Tracer:
+    """ Tracer emits structured records of a subsystem, e.g. one record per frame.
+    It is disabled by default and only every sample_every-th frame is traced.
+    Callers check active() before building a record so that nothing is formatted
+    when tracing is off,
+
+        if tracer.active(frame):
+            tracer.emit(frame=frame, ids=ids)
+    """
+    def __init__(self, subsystem):
+        self.subsystem = subsystem
+        self.enabled = False
+        self.sample_every = 1
+        self.sink = None
+
+    def active(self, frame):
+        return self.enabled and frame % self.sample_every == 0
+
+    def emit(self, **record):
+        record["subsystem"] = self.subsystem
+        self.sink.write(record)
+
+
+class FileSink:
+    """ FileSink writes records as JSON lines
+    """
+    def __init__(self, path):
+        self.fp = open(path, "a")
+
+    def write(self, record):
+        self.fp.write(json.dumps(record, separators=(",", ":"), default=to_json))
+        self.fp.write("\n")
+
+    def close(self):
+        self.fp.close()
+
+
+class RingSink:
+    """ RingSink keeps the most recent records in memory
+    """
+    def __init__(self, size=1000):
+        self.records = deque(maxlen=size)
+
+    def write(self, record):
+        self.records.append(record)
+
+    def close(self):
+        pass
+
+
+def to_json(o):
+    if isinstance(o, np.ndarray):
+        return o.tolist()
+    if isinstance(o, np.generic):
+        return o.item()
+    raise TypeError(f"{type(o)} is not JSON serializable")
+
+
+_tracers = {}
+
+
+def get_tracer(subsystem):
+    """ get_tracer returns the tracer of the subsystem; it is disabled until configured
+    """
+    tracer = _tracers.get(subsystem)
+    if tracer is None:
+        tracer = Tracer(subsystem)
+        _tracers[subsystem] = tracer
+    return tracer
+
+
+def configure(subsystems, path="", sample_every=1, ring_size=1000):
+    """ configure enables tracing of the subsystems. Records go to path as JSON lines,
+    or to an in-memory ring buffer of ring_size records if path is empty.
+    It returns the sink, which the caller closes when done.
+    """
+    sink = FileSink(path) if path != "" else RingSink(ring_size)
+    for subsystem in subsystems:
+        tracer = get_tracer(subsystem)
+        tracer.enabled = True
+        tracer.sample_every = max(1, sample_every)
+        tracer.sink = sink
+    logging.info(f"Tracing {', '.join(subsystems)} every {sample_every} frame(s)")
+    return sink
@@ -0,0 +1,171 @@
+""" Shared memory transport of frames between processes.
+
+Decoding in a process of its own keeps the GIL and crashes of the decoder away
+from inference. Frames are not pickled through a queue: the decoder decodes
+into a slot of a ring in shared memory and only the index of the slot is passed
+to the consumer, which reads the frame in place and passes the index back once
+it is done with it.
+
+It needs Python 3.8 for shared memory; app.py imports it only with --decode-process.
+
+    with RingReader("clip.mp4") as reader:
+        for frame in reader.stream():
+            ...
+"""
+import logging
+import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+
+import cv2
+import numpy as np
+from waggle.data.timestamp import get_timestamp
+
+from decoding import Frame, close_block
+
+
+class FrameRing:
+    """ FrameRing is a ring of slots of fixed-size frames in shared memory between one producer
+    and one consumer process. A slot belongs to the producer from acquire until publish and to
+    the consumer from receive until release, so the frames need no lock; the indices of the slots
+    go through one-way pipes, which also block a side that waits for the other.
+    """
+    def __init__(self, slots, shape, dtype=np.uint8):
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.shm = SharedMemory(create=True, size=slots * int(np.prod(self.shape)) * self.dtype.itemsize)
+        self.frames = np.ndarray((slots, *self.shape), dtype=self.dtype, buffer=self.shm.buf)
+        self.published_recv, self.published_send = mp.Pipe(duplex=False)
+        self.free_recv, self.free_send = mp.Pipe(duplex=False)
+        for slot in range(slots):
+            self.free_send.send(slot)
+
+    def __getstate__(self):
+        # The other process attaches to the same block
+        state = self.__dict__.copy()
+        state["shm"] = self.shm.name
+        del state["frames"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = SharedMemory(name=state["shm"])
+        self.frames = np.ndarray((self.slots, *self.shape), dtype=self.dtype, buffer=self.shm.buf)
+
+    # Producer
+    def acquire(self):
+        """ acquire returns the index of a free slot, waiting for the consumer to release one
+        """
+        return self.free_recv.recv()
+
+    def publish(self, slot, timestamp):
+        self.published_send.send((slot, timestamp))
+
+    def finish(self):
+        self.published_send.send(None)
+
+    # Consumer
+    def receive(self):
+        """ receive returns the index and the timestamp of the next published slot, or None at
+        the end. It raises EOFError if the producer exited without finishing.
+        """
+        return self.published_recv.recv()
+
+    def release(self, slot):
+        self.free_send.send(slot)
+
+    def close_producer(self):
+        """ close_producer closes the producer ends in the consumer once the producer has them,
+        so that the consumer sees the end of the pipe if the producer exits
+        """
+        self.published_send.close()
+        self.free_recv.close()
+
+    def close(self):
+        self.frames = None
+        close_block(self.shm)
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def decode_to_ring(path, ring):
+    """ decode_to_ring decodes the frames of the video into slots of the ring, converted to RGB in place
+    """
+    capture = cv2.VideoCapture(path)
+    try:
+        while capture.grab():
+            timestamp = get_timestamp()
+            slot = ring.acquire()
+            frame = ring.frames[slot]
+            ok, data = capture.retrieve(frame)
+            if not ok:
+                break
+            if data.ctypes.data != frame.ctypes.data:
+                raise RuntimeError(f"frame of shape {data.shape} does not fit the slots of shape {frame.shape}")
+            cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
+            ring.publish(slot, timestamp)
+        # Without it, the consumer sees the pipe close and logs the failure
+        ring.finish()
+    finally:
+        capture.release()
+        frame = data = None
+        ring.close()
+
+
+class RingReader:
+    """ RingReader reads the frames of a video in order like waggle's Camera, decoded by another
+    process into a FrameRing of the given number of slots. A frame is a view of its slot that is
+    valid until the next frame is read; copy it to keep it longer. Given the StreamInfo of the
+    video, the slots are sized by it rather than by opening the video once more for its size.
+    """
+    def __init__(self, path, slots=8, info=None):
+        self.path = str(path)
+        self.slots = slots
+        self.info = info
+        self.ring = None
+        self.process = None
+
+    def __enter__(self):
+        if self.info is not None:
+            shape = (self.info.height, self.info.width, 3)
+        else:
+            capture = cv2.VideoCapture(self.path)
+            if not capture.isOpened():
+                raise RuntimeError(f"unable to open video capture for {self.path}")
+            shape = (int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), 3)
+            capture.release()
+        self.ring = FrameRing(self.slots, shape)
+        # A fresh process, as the caller may hold CUDA, which does not survive fork
+        self.process = mp.get_context("spawn").Process(target=decode_to_ring, args=(self.path, self.ring), daemon=True)
+        self.process.start()
+        self.ring.close_producer()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self.ring.close()
+        self.ring.unlink()
+
+    def stream(self):
+        slot = None
+        while True:
+            if slot is not None:
+                # The caller is done with the frame once it asks for the next
+                try:
+                    self.ring.release(slot)
+                except BrokenPipeError:
+                    # The decoder is gone; what it published is still to be received
+                    pass
+            try:
+                published = self.ring.receive()
+            except EOFError:
+                self.process.join()
+                logging.error(f"Decoder of {self.path} exited with {self.process.exitcode}")
+                return
+            if published is None:
+                return
+            slot, timestamp = published
+            yield Frame(self.ring.frames[slot], timestamp)